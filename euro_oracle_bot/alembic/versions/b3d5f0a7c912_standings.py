@@ -0,0 +1,39 @@
+"""standings
+
+Revision ID: b3d5f0a7c912
+Revises: e7f8b82d596e
+Create Date: 2026-10-17 11:20:41.512734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d5f0a7c912'
+down_revision = 'e7f8b82d596e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('standing',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('points', sa.Integer(), nullable=False),
+                    sa.Column('user_created', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('user_id')
+                    )
+    op.create_index('ix_standing_rank', 'standing',
+                    [sa.text('points DESC'), 'user_created'], unique=False)
+    op.execute(
+        'INSERT INTO standing (user_id, points, user_created) '
+        'SELECT "user".id, COALESCE(SUM(prediction.points), 0), "user".created '
+        'FROM "user" JOIN prediction ON prediction.user_id = "user".id '
+        'GROUP BY "user".id'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_standing_rank', table_name='standing')
+    op.drop_table('standing')
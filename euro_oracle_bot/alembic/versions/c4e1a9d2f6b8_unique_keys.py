@@ -0,0 +1,72 @@
+"""unique keys
+
+Revision ID: c4e1a9d2f6b8
+Revises: b3d5f0a7c912
+Create Date: 2026-10-17 15:02:11.204318
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e1a9d2f6b8'
+down_revision = 'b3d5f0a7c912'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Duplicates are merged into the row with the lowest id, references are moved to it
+    op.execute(
+        'UPDATE match SET team_home_id = keep.id FROM team dup, '
+        '(SELECT api_id, MIN(id) AS id FROM team GROUP BY api_id) keep '
+        'WHERE match.team_home_id = dup.id AND dup.api_id = keep.api_id AND dup.id <> keep.id'
+    )
+    op.execute(
+        'UPDATE match SET team_away_id = keep.id FROM team dup, '
+        '(SELECT api_id, MIN(id) AS id FROM team GROUP BY api_id) keep '
+        'WHERE match.team_away_id = dup.id AND dup.api_id = keep.api_id AND dup.id <> keep.id'
+    )
+    op.execute(
+        'DELETE FROM team dup USING team keep '
+        'WHERE dup.api_id = keep.api_id AND dup.id > keep.id'
+    )
+    for table, column in (('match', 'match_id'), ('"user"', 'user_id')):
+        op.execute(
+            f'UPDATE prediction SET {column} = keep.id FROM {table} dup, '
+            f'(SELECT api_id, MIN(id) AS id FROM {table} GROUP BY api_id) keep '
+            f'WHERE prediction.{column} = dup.id AND dup.api_id = keep.api_id '
+            f'AND dup.id <> keep.id'
+        )
+        op.execute(
+            f'DELETE FROM {table} dup USING {table} keep '
+            f'WHERE dup.api_id = keep.api_id AND dup.id > keep.id'
+        )
+    # the latest prediction of user for match wins
+    op.execute(
+        'DELETE FROM prediction dup USING prediction keep '
+        'WHERE dup.user_id = keep.user_id AND dup.match_id = keep.match_id AND dup.id < keep.id'
+    )
+    op.execute('DELETE FROM standing')
+    op.execute(
+        'INSERT INTO standing (user_id, points, user_created) '
+        'SELECT "user".id, COALESCE(SUM(prediction.points), 0), "user".created '
+        'FROM "user" JOIN prediction ON prediction.user_id = "user".id '
+        'GROUP BY "user".id'
+    )
+
+    op.drop_index('ix_prediction_user_id', table_name='prediction')
+    op.create_unique_constraint('uq_prediction_user_match', 'prediction', ['user_id', 'match_id'])
+    op.drop_index('ix_user_api_id', table_name='user')
+    op.create_index('ix_user_api_id', 'user', ['api_id'], unique=True)
+    op.create_index('ix_team_api_id', 'team', ['api_id'], unique=True)
+    op.create_index('ix_match_api_id', 'match', ['api_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_match_api_id', table_name='match')
+    op.drop_index('ix_team_api_id', table_name='team')
+    op.drop_index('ix_user_api_id', table_name='user')
+    op.create_index('ix_user_api_id', 'user', ['api_id'], unique=False)
+    op.drop_constraint('uq_prediction_user_match', 'prediction', type_='unique')
+    op.create_index('ix_prediction_user_id', 'prediction', ['user_id'], unique=False)
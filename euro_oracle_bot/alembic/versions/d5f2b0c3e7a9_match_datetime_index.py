@@ -0,0 +1,23 @@
+"""match datetime index
+
+Revision ID: d5f2b0c3e7a9
+Revises: c4e1a9d2f6b8
+Create Date: 2026-10-17 16:41:53.118602
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5f2b0c3e7a9'
+down_revision = 'c4e1a9d2f6b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_match_datetime'), 'match', ['datetime'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_match_datetime'), table_name='match')
@@ -0,0 +1,24 @@
+"""chat stage updated
+
+Revision ID: f1b7c2d8e4a6
+Revises: d5f2b0c3e7a9
+Create Date: 2026-10-17 19:52:37.640215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7c2d8e4a6'
+down_revision = 'd5f2b0c3e7a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('chat_stage_updated', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'chat_stage_updated')
@@ -0,0 +1,134 @@
+"""
+Benchmark of next not predicted match lookup: NOT IN query against in-memory
+predicted match sets checked against sorted upcoming matches.
+Predictions are stored in in-memory SQLite, so absolute query times differ from Postgres.
+Run at euro_oracle_bot directory: python -m benchmarks.next_match [users]
+"""
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, asc
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Team, Match, Prediction
+from models import STAGE_1, MATCH_STATUS_NOT_STARTED
+from services.schedule import ScheduleSnapshot
+
+MATCHES = 51
+SAMPLE = 2000
+
+
+def build_matches(now: datetime) -> list[Match]:
+    teams = [Team(id=idx + 1, api_id=idx + 1, title=f"Team {idx}") for idx in range(24)]
+    # a bit more than half of the season is played
+    start = now - timedelta(days=17)
+    return [Match(id=idx + 1, api_id=idx + 1, datetime=start + timedelta(hours=idx * 16),
+                  stage=STAGE_1, group="A", status=MATCH_STATUS_NOT_STARTED,
+                  team_home_id=teams[idx % 24].id, team_away_id=teams[(idx + 1) % 24].id,
+                  team_home=teams[idx % 24], team_away=teams[(idx + 1) % 24])
+            for idx in range(MATCHES)]
+
+
+def build_predictions(users: int) -> dict[int, list[int]]:
+    """
+    Users predict matches mostly in order, some skip a few
+    """
+    predicted = {}
+    for user_id in range(1, users + 1):
+        count = min(int(random.triangular(0, MATCHES + 10, MATCHES)), MATCHES)
+        predicted[user_id] = [match_id for match_id in range(1, count + 1)
+                              if random.random() > 0.05]
+    return predicted
+
+
+def fill_db(session_maker, matches: list[Match], predicted: dict[int, list[int]]):
+    with session_maker() as sess:
+        sess.bulk_insert_mappings(Match, [{
+            "id": match.id, "api_id": match.api_id, "datetime": match.datetime,
+            "stage": match.stage, "group": match.group, "status": match.status,
+        } for match in matches])
+        sess.commit()
+        conn = sess.connection().connection
+        conn.executemany(
+            "INSERT INTO prediction (user_id, match_id, home_goals, away_goals, points) "
+            "VALUES (?, ?, 1, 0, 0)",
+            ((user_id, match_id) for user_id, ids in predicted.items() for match_id in ids)
+        )
+        conn.commit()
+
+
+def next_match_not_in(session_maker, user_id: int, now: datetime):
+    # query used before schedule store
+    with session_maker() as sess:
+        subquery = sess.query(Prediction).filter(Prediction.user_id == user_id)
+        subquery = subquery.with_entities(Prediction.match_id)
+        query = sess.query(Match).order_by(asc(Match.datetime))
+        query = query.filter(Match.id.not_in(subquery))
+        query = query.filter(Match.datetime > now)
+        return query.first()
+
+
+def predicted_ids(session_maker, user_id: int) -> frozenset:
+    with session_maker() as sess:
+        query = sess.query(Prediction.match_id).filter(Prediction.user_id == user_id)
+        return frozenset(row.match_id for row in query)
+
+
+def next_match_in_memory(snapshot: ScheduleSnapshot, predicted: frozenset, now: datetime):
+    for match in snapshot.upcoming(now):
+        if match.id not in predicted:
+            return match
+    return None
+
+
+def bench(name: str, lookup, user_ids: list[int]):
+    start = time.perf_counter()
+    for user_id in user_ids:
+        lookup(user_id)
+    elapsed = time.perf_counter() - start
+    print(f"{name:32} {elapsed / len(user_ids) * 1e6:10.1f} us/lookup")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(2021)
+    now = datetime.utcnow()
+    matches = build_matches(now)
+    predicted = build_predictions(users)
+    rows = sum(len(ids) for ids in predicted.values())
+    print(f"{users} users, {MATCHES} matches, {rows} predictions")
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session_maker = sessionmaker(bind=engine)
+    fill_db(session_maker, matches, predicted)
+
+    snapshot = ScheduleSnapshot(matches, [], 1)
+    tracemalloc.start()
+    cache = {user_id: frozenset(ids) for user_id, ids in predicted.items()}
+    cache_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"predicted sets of all users take {cache_size / 2 ** 20:.1f} MiB")
+
+    sample = random.sample(range(1, users + 1), min(SAMPLE, users))
+    for user_id in sample[:200]:
+        expected = next_match_not_in(session_maker, user_id, now)
+        actual = next_match_in_memory(snapshot, cache[user_id], now)
+        if (expected and expected.id) != (actual and actual.id):
+            raise AssertionError(f"lookups differ for user {user_id}")
+    print("results are identical")
+
+    bench("NOT IN query", lambda user_id: next_match_not_in(session_maker, user_id, now),
+          sample)
+    bench("predicted ids query + snapshot",
+          lambda user_id: next_match_in_memory(snapshot, predicted_ids(session_maker, user_id),
+                                               now), sample)
+    bench("cached set + snapshot",
+          lambda user_id: next_match_in_memory(snapshot, cache[user_id], now), sample)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of services.render against __str__ of models.
+Run at euro_oracle_bot directory: python -m benchmarks.render
+"""
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from models import User, Team, Match, Prediction
+from models import STAGE_1, STAGE_2, STAGE_3, STAGE_18, STAGE_14, STAGE_12, STAGE_FINAL
+from models import MATCH_STATUS_NOT_STARTED, MATCH_STATUS_IN_PROGRESS, MATCH_STATUS_FINISHED
+from services.render import render_match, render_prediction, render_user, render_lines
+
+STAGES = [STAGE_1, STAGE_2, STAGE_3, STAGE_18, STAGE_14, STAGE_12, STAGE_FINAL]
+STATUSES = [MATCH_STATUS_NOT_STARTED, MATCH_STATUS_IN_PROGRESS, MATCH_STATUS_FINISHED]
+
+
+def build_matches(count: int) -> list[Match]:
+    teams = [Team(id=idx, title=f"Team {idx}") for idx in range(24)]
+    start = datetime(2021, 6, 11, 19)
+    matches = []
+    for idx in range(count):
+        home, away = random.sample(teams, 2)
+        goals = [random.randint(0, 4) for _ in range(2)]
+        extra = [random.randint(0, 1) for _ in range(2)]
+        pens = [random.randint(0, 5) for _ in range(2)] if random.random() < 0.2 else [None, None]
+        matches.append(Match(
+            id=idx + 1, datetime=start + timedelta(hours=idx * 5),
+            stage=random.choice(STAGES), group=random.choice("ABCDEF"),
+            team_home=home, team_away=away, status=random.choice(STATUSES),
+            home_goals_90=goals[0], away_goals_90=goals[1],
+            home_goals_total=goals[0] + extra[0], away_goals_total=goals[1] + extra[1],
+            home_goals_pen=pens[0], away_goals_pen=pens[1],
+        ))
+    return matches
+
+
+def build_predictions(matches: list[Match]) -> list[Prediction]:
+    return [Prediction(match=match, home_goals=random.randint(0, 3),
+                       away_goals=random.randint(0, 3), points=random.randint(0, 5))
+            for match in matches]
+
+
+def build_users(count: int) -> list[User]:
+    names = [None, "Иван_Петров", "John *Smith*", "[bot] user"]
+    return [User(id=idx, full_name=random.choice(names), username=random.choice(names))
+            for idx in range(count)]
+
+
+def check_equal(items: list, render, name: str):
+    for item in items:
+        expected = str(item)
+        actual = render(item)
+        if expected != actual:
+            raise AssertionError(f"{name} output differs:\n{expected!r}\n{actual!r}")
+
+
+def bench(name: str, items: list, render, number: int):
+    old = timeit.timeit(lambda: "".join(f"{item}\n" for item in items), number=number)
+    new = timeit.timeit(lambda: render_lines(items, render), number=number)
+    print(f"{name:12} __str__: {old / number * 1000:8.3f} ms  "
+          f"render: {new / number * 1000:8.3f} ms  x{old / new:.1f}")
+
+
+def main():
+    random.seed(2021)
+    matches = build_matches(51)
+    predictions = build_predictions(matches)
+    users = build_users(30)
+
+    check_equal(matches, render_match, "match")
+    check_equal(predictions, render_prediction, "prediction")
+    check_equal(users, render_user, "user")
+    print("output is identical to __str__")
+
+    bench("matches", matches, render_match, 500)
+    bench("predictions", predictions, render_prediction, 500)
+    bench("users", users, render_user, 2000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Check of SQL scoring expression against reference implementation and benchmark
+of scoring all predictions of one match with single UPDATE.
+Predictions are stored in in-memory SQLite without matches, as scoring doesn't read them,
+so absolute times differ from Postgres.
+Run at euro_oracle_bot directory: python -m benchmarks.scoring [predictions]
+"""
+import itertools
+import random
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Prediction
+from services.scoring import BIG_WIN_DIFF, points_expression, score_prediction
+
+# covers draws, small and big wins of both teams
+GOALS = range(0, BIG_WIN_DIFF + 4)
+
+
+def score_all(session_maker, match_id: int, home_goals: int, away_goals: int):
+    with session_maker() as sess:
+        sess.query(Prediction).filter(Prediction.match_id == match_id).update({
+            Prediction.points: points_expression(home_goals, away_goals),
+        }, synchronize_session=False)
+        sess.commit()
+
+
+def check(session_maker) -> int:
+    """
+    Scores every predicted score of every match result in grid, raises on first mismatch.
+    Returns number of checked predictions.
+    """
+    scores = list(itertools.product(GOALS, GOALS))
+    with session_maker() as sess:
+        sess.bulk_insert_mappings(Prediction, [{
+            "user_id": user_idx + 1, "match_id": match_idx + 1,
+            "home_goals": pred[0], "away_goals": pred[1], "points": 0,
+        } for match_idx in range(len(scores)) for user_idx, pred in enumerate(scores)])
+        sess.commit()
+
+    for match_idx, (home_goals, away_goals) in enumerate(scores):
+        score_all(session_maker, match_idx + 1, home_goals, away_goals)
+
+    with session_maker() as sess:
+        rows = sess.query(Prediction.match_id, Prediction.home_goals, Prediction.away_goals,
+                          Prediction.points).all()
+    for match_id, pred_home, pred_away, points in rows:
+        home_goals, away_goals = scores[match_id - 1]
+        expected = score_prediction(home_goals, away_goals, pred_home, pred_away)
+        if points != expected:
+            raise AssertionError(f"match {home_goals} - {away_goals}, prediction "
+                                 f"{pred_home} - {pred_away}: SQL gives {points}, "
+                                 f"reference gives {expected}")
+    return len(rows)
+
+
+def bench(session_maker, count: int):
+    with session_maker() as sess:
+        sess.bulk_insert_mappings(Prediction, [{
+            "user_id": idx + 1, "match_id": 0,
+            "home_goals": random.randint(0, 4), "away_goals": random.randint(0, 4), "points": 0,
+        } for idx in range(count)])
+        sess.commit()
+
+    start = time.perf_counter()
+    score_all(session_maker, 0, 2, 1)
+    elapsed = time.perf_counter() - start
+    print(f"{count} predictions of one match scored in {elapsed * 1000:.1f} ms")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(2021)
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session_maker = sessionmaker(bind=engine)
+
+    checked = check(session_maker)
+    print(f"{checked} predictions scored by SQL expression match reference implementation")
+    bench(session_maker, count)
+
+
+if __name__ == '__main__':
+    main()
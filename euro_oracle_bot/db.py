@@ -1,18 +1,31 @@
 """
 Database service classes
 """
+import itertools
+import threading
+import time
+from contextlib import contextmanager
 from logging import Logger
+from typing import Callable, Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine, Connection
 from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from metrics import Counter, Histogram, Family
+
+# seconds replica is not used after connection error
+REPLICA_RETRY_INTERVAL = 30.0
 
 
 class SessionContext:
     _logger: Logger
 
-    def __init__(self, session):
+    def __init__(self, session: Session, db: "Db"):
         self.session = session
+        self.db = db
         if self._logger is None:
             raise AttributeError("logger not set")
 
@@ -24,33 +37,346 @@ class SessionContext:
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is not None:
+        try:
+            if exc_type is None:
+                try:
+                    self.session.commit()
+                except SQLAlchemyError as exc:
+                    self._logger.error(f"DB commit error: {exc.args}")
+                    self._rollback()
+                    raise Exception from exc
+                self.db.commits.inc()
+                return
+
             self._logger.error(f"DB error: {exc_val.args}")
-            self.session.rollback()
+            self._rollback()
             if issubclass(exc_type, SQLAlchemyError):
                 raise Exception from exc_val
-        else:
-            self.session.commit()
-        self.session.close()
+        finally:
+            self.session.close()
+
+    def _rollback(self):
+        try:
+            self.session.rollback()
+        except SQLAlchemyError as exc:
+            self._logger.error(f"DB rollback error: {exc.args}")
+        self.db.rollbacks.inc()
+
+
+class UnitOfWork(SessionContext):
+    """
+    Session shared by all session_scope() calls of current thread until exit,
+    so they are committed (or rolled back) once
+    """
+
+    def __init__(self, session: Session, db: "Db"):
+        super().__init__(session, db)
+        self._on_rollback: list[Callable[[], None]] = []
 
+    def on_rollback(self, callback: Callable[[], None]):
+        self._on_rollback.append(callback)
+
+    def __enter__(self) -> Session:
+        self.db.local.unit = self
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.db.local.unit = None
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+    def _rollback(self):
+        super()._rollback()
+        for callback in self._on_rollback:
+            callback()
+
+
+class _NestedSessionContext:
+    def __init__(self, session: Session):
+        self.session = session
 
+    def __enter__(self) -> Session:
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # flush, so ids are assigned and errors are raised where they happen,
+        # commit or rollback is left to unit of work
+        if exc_type is None:
+            self.session.flush()
+
+
+# pylint: disable=too-few-public-methods
+class PoolMetrics:
+    def __init__(self):
+        self.checkout_latency = Histogram()
+        self.timeouts = Counter()
+        self.connects = Counter()
+        self.checkouts = Counter()
+        self.invalidated = Counter()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool which measures time spent waiting for connection
+    """
+    metrics: PoolMetrics
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.timeouts.inc()
+            raise
+        finally:
+            self.metrics.checkout_latency.observe(time.perf_counter() - start)
+
+    def recreate(self):
+        # pool is recreated on engine dispose, metrics are kept
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class _Replica:
+    def __init__(self, engine: Engine, session_maker: sessionmaker):
+        self.engine = engine
+        self.session_maker = session_maker
+        self.metrics = engine.pool.metrics
+        # monotonic time until which replica is not used after connection error
+        self.down_until = 0.0
+
+
+# pylint: disable=too-many-instance-attributes
 class Db:
-    def __init__(self, dsn: str, logger: Logger):
+    # pylint: disable=too-many-arguments
+    def __init__(self, dsn: str, logger: Logger,
+                 pool_size: int = 5,
+                 max_overflow: int = 10,
+                 pool_timeout: float = 30.0,
+                 pool_recycle: int = 1800,
+                 pool_pre_ping: bool = False,
+                 statement_timeout: int = 0,
+                 replica_dsns: Optional[list[str]] = None):
         """
         :arg: dsn - connection url
         :arg: logger - logger object
+        :arg: pool_size - number of connections kept open
+        :arg: max_overflow - max connections opened above pool_size under load
+        :arg: pool_timeout - seconds to wait for free connection before error
+        :arg: pool_recycle - seconds after which connection is reopened, -1 disables it
+        :arg: pool_pre_ping - check connection is alive on every checkout
+        :arg: statement_timeout - Postgres statement timeout in milliseconds, 0 disables it
+        :arg: replica_dsns - connection urls of read replicas, used by read-only sessions
         """
         self._dsn = dsn
-        self._engine = create_engine(dsn, client_encoding='utf8')
-        self._session_maker = sessionmaker(bind=self._engine, class_=Session)
         self.logger = logger
+        self.local = threading.local()
+        # operation name -> duration of every query, see operation()
+        self.query_latency = Family(Histogram)
+        self.query_errors = Family(Counter)
+        self._engine_options = {
+            "client_encoding": "utf8",
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "pool_timeout": pool_timeout,
+            "pool_recycle": pool_recycle,
+            "pool_pre_ping": pool_pre_ping,
+            "connect_args": {},
+        }
+        if statement_timeout > 0:
+            self._engine_options["connect_args"]["options"] = \
+                f"-c statement_timeout={statement_timeout}"
+        self._engine = self._create_engine(dsn)
+        self.pool_metrics = self._engine.pool.metrics
+        self._session_maker = sessionmaker(bind=self._engine, class_=Session)
+        self._listen_writes(self._session_maker)
+        self._replicas = []
+        for replica_dsn in replica_dsns or []:
+            engine = self._create_engine(replica_dsn)
+            replica = _Replica(engine, sessionmaker(bind=engine, class_=Session))
+            self._listen_disconnects(replica)
+            self._replicas.append(replica)
+        self._next_replica = itertools.count()
+        self.commits = Counter()
+        self.rollbacks = Counter()
+        self.replica_reads = Counter()
+        self.replica_fallbacks = Counter()
         SessionContext.set_logger(logger)
 
+    def _create_engine(self, dsn: str) -> Engine:
+        engine = create_engine(dsn, **self._engine_options)
+        metrics = PoolMetrics()
+        engine.pool.metrics = metrics
+        # engine events are propagated to recreated pools as well
+        event.listen(engine, "connect", lambda *_: metrics.connects.inc())
+        event.listen(engine, "checkout", lambda *_: metrics.checkouts.inc())
+        event.listen(engine, "invalidate", lambda *_: metrics.invalidated.inc())
+        self._listen_queries(engine)
+        return engine
+
+    def _listen_queries(self, engine: Engine):
+        def before_execute(conn, *_):
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+        def after_execute(conn, *_):
+            started = conn.info["query_started"].pop()
+            self.query_latency.labels(self.current_operation()).observe(
+                time.perf_counter() - started
+            )
+
+        def on_error(context):
+            started = context.connection.info.get("query_started") \
+                if context.connection is not None else None
+            if started:
+                started.pop()
+            self.query_errors.labels(self.current_operation()).inc()
+
+        event.listen(engine, "before_cursor_execute", before_execute)
+        event.listen(engine, "after_cursor_execute", after_execute)
+        event.listen(engine, "handle_error", on_error)
+
+    @staticmethod
+    def _listen_writes(session_maker: sessionmaker):
+        # sessions which wrote something read from primary, so writes are visible
+        def mark_written(session: Session, *_):
+            session.info["written"] = True
+
+        def on_execute(state):
+            if not state.is_select:
+                mark_written(state.session)
+
+        event.listen(session_maker, "after_flush", mark_written)
+        event.listen(session_maker, "do_orm_execute", on_execute)
+
+    def _listen_disconnects(self, replica: _Replica):
+        def on_error(context):
+            if context.is_disconnect:
+                self.logger.error(f"replica {replica.engine.url.host} is unavailable: "
+                                  f"{str(context.original_exception)}")
+                replica.down_until = time.monotonic() + REPLICA_RETRY_INTERVAL
+
+        event.listen(replica.engine, "handle_error", on_error)
+
+    def _pick_replica(self) -> Optional[_Replica]:
+        """
+        Next healthy replica in round robin order, replica which was down is checked
+        with a query before use. Returns None if all replicas are down.
+        """
+        now = time.monotonic()
+        for _ in range(len(self._replicas)):
+            replica = self._replicas[next(self._next_replica) % len(self._replicas)]
+            if replica.down_until == 0.0:
+                return replica
+            if replica.down_until > now:
+                continue
+            try:
+                with replica.engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+            except SQLAlchemyError:
+                replica.down_until = now + REPLICA_RETRY_INTERVAL
+                continue
+            self.logger.info(f"replica {replica.engine.url.host} is available again")
+            replica.down_until = 0.0
+            return replica
+
+        return None
+
+    def connect(self) -> Connection:
+        """
+        Connection to primary outside of sessions, e.g. to hold session level lock.
+        It is taken from pool until closed.
+        """
+        return self._engine.connect()
+
     def close(self):
+        for replica in self._replicas:
+            replica.engine.dispose()
+        self._replicas = []
         self._engine.dispose()
         self._engine = None
         self._session_maker = None
 
-    def session_scope(self) -> SessionContext:
+    def session_scope(self, shared: bool = True, readonly: bool = False):
+        """
+        :arg: shared - join unit of work of current thread if there is one
+        :arg: readonly - session may be served by replica, unless unit of work
+        of current thread has already written something
+        """
+        unit = self.current_unit()
+        if readonly and self._replicas and \
+                not (unit is not None and unit.session.info.get("written")):
+            replica = self._pick_replica()
+            if replica is not None:
+                self.replica_reads.inc()
+                return SessionContext(replica.session_maker(expire_on_commit=False), self)
+            self.replica_fallbacks.inc()
+
+        if shared and unit is not None:
+            return _NestedSessionContext(unit.session)
+
         session_ = self._session_maker(expire_on_commit=False)
-        return SessionContext(session_)
+        return SessionContext(session_, self)
+
+    def unit_of_work(self):
+        """
+        Opens session which is used by every session_scope() of current thread
+        and is committed once on exit
+        """
+        unit = self.current_unit()
+        if unit is not None:
+            return _NestedSessionContext(unit.session)
+
+        session_ = self._session_maker(expire_on_commit=False)
+        return UnitOfWork(session_, self)
+
+    @contextmanager
+    def operation(self, name: str):
+        """
+        Queries of current thread run inside are measured under given name
+        """
+        previous = getattr(self.local, "operation", None)
+        self.local.operation = name
+        try:
+            yield
+        finally:
+            self.local.operation = previous
+
+    def current_operation(self) -> str:
+        return getattr(self.local, "operation", None) or "other"
+
+    def current_unit(self) -> Optional[UnitOfWork]:
+        return getattr(self.local, "unit", None)
+
+    def on_rollback(self, callback: Callable[[], None]):
+        """
+        Registers callback called if current unit of work is rolled back,
+        e.g. to drop cached objects. Does nothing outside of unit of work.
+        """
+        unit = self.current_unit()
+        if unit is not None:
+            unit.on_rollback(callback)
+
+    def stats(self) -> dict:
+        pool = self._engine.pool
+        return {
+            "commits": self.commits.value,
+            "rollbacks": self.rollbacks.value,
+            "pool_size": pool.size(),
+            "pool_in_use": pool.checkedout(),
+            "pool_idle": pool.checkedin(),
+            "pool_overflow": pool.overflow(),
+            "pool_connects": self.pool_metrics.connects.value,
+            "pool_checkouts": self.pool_metrics.checkouts.value,
+            "pool_invalidated": self.pool_metrics.invalidated.value,
+            "pool_timeouts": self.pool_metrics.timeouts.value,
+            "pool_checkout_latency": self.pool_metrics.checkout_latency.snapshot(),
+            "replica_reads": self.replica_reads.value,
+            "replica_fallbacks": self.replica_fallbacks.value,
+            "replicas": [{
+                "host": replica.engine.url.host,
+                "healthy": replica.down_until == 0.0,
+                "pool_in_use": replica.engine.pool.checkedout(),
+                "pool_timeouts": replica.metrics.timeouts.value,
+            } for replica in self._replicas],
+        }
@@ -1,21 +1,320 @@
+import sys
+import signal
 import logging
+import argparse
+import threading
+import multiprocessing
+from typing import Callable, Optional
+
+import telebot
+from telebot import apihelper
+from telebot.types import Update
+
 import log
 from settings import Settings
 from settings import settings as bot_settings
 
 from db import Db
+from metrics import PrometheusText, PROMETHEUS_CONTENT_TYPE
 from services.storage import StorageService
 from services.bot import BotService
+from services.logsink import UserLogSink
+from services.conversation import ConversationStore
+from services.notifier import NotificationDispatcher
+from services.api import ApiService
+from services.dataapi import DataApiClient
+from services.snapshot import FixtureSnapshot
+from services.scheduler import SyncScheduler
+from services.webhook import WebhookServer, set_webhook
+from services.poller import UpdatePoller
+from services.leader import LeaderElection
+from services.status import StatusServer
+from services.workers import WorkerPool
+
+
+def create_db(settings: Settings, logger: logging.Logger) -> Db:
+    replica_dsns = [dsn.strip() for dsn in settings.postgres_replica_dsns.split(",")
+                    if dsn.strip()]
+    return Db(settings.postgres_dsn, logger,
+              settings.db_pool_size,
+              settings.db_max_overflow,
+              settings.db_pool_timeout,
+              settings.db_pool_recycle,
+              settings.db_pool_pre_ping,
+              settings.db_statement_timeout,
+              replica_dsns)
+
+
+# pylint: disable=too-many-instance-attributes
+class BotProcess:
+    """
+    Services of process which handles updates. Only process holding leader lock
+    syncs fixtures and scores matches, others reload schedule written by it.
+    """
+
+    def __init__(self, settings: Settings, logger: logging.Logger,
+                 shard: int = 0, shards: int = 1,
+                 on_leader_change: Optional[Callable[[bool], None]] = None):
+        """
+        :arg: shard - index of process among handler processes
+        :arg: shards - number of handler processes
+        :arg: on_leader_change - called when process becomes leader or stops being it
+        """
+        self.db_service = create_db(settings, logger)
+        self.storage = StorageService(self.db_service, logger,
+                                      settings.user_cache_size, settings.user_cache_ttl)
+        self.log_sink = UserLogSink(self.storage, logger, settings.userlog_batch_size,
+                                    settings.userlog_flush_interval)
+        self.conversations = ConversationStore(self.storage, logger, settings.conversation_ttl,
+                                               settings.conversation_flush_interval)
+        self.conversations.recover(shard, shards)
+        self.bot = BotService(self.storage, self.log_sink, self.conversations,
+                              settings.bot_token, logger,
+                              settings.handler_workers, settings.handler_queue_size)
+        self.notifier = NotificationDispatcher(self.bot.send_notification, logger,
+                                               settings.notification_workers,
+                                               settings.notification_max_retries)
+        self.data_api = DataApiClient(settings.data_api_token, logger, settings.data_api_url,
+                                      settings.data_api_auth_url, settings.data_api_timeout)
+        snapshot = None
+        if settings.fixtures_snapshot_path:
+            snapshot = FixtureSnapshot(settings.fixtures_snapshot_path, logger)
+        self.api = ApiService(self.storage, self.notifier, self.data_api, logger, snapshot,
+                              settings.fixtures_max_age)
+        self.leader = LeaderElection(self.db_service.connect, settings.leader_lock_id, logger,
+                                     on_leader_change)
+        self.scheduler = SyncScheduler(self.leader.guard(self.api.update),
+                                       self.api.next_sync_delay, logger)
+        self.schedule_interval = settings.schedule_refresh_interval
+        self.schedule_refresher = SyncScheduler(self.storage.schedule.refresh_if_changed,
+                                                lambda: self.schedule_interval, logger)
+
+    def start(self):
+        self.log_sink.start()
+        self.conversations.start()
+        self.notifier.start()
+        self.scheduler.start()
+        self.schedule_refresher.start(self.schedule_interval)
+        self.bot.start()
+
+    def metrics(self) -> bytes:
+        page = PrometheusText("euro_oracle_bot_")
+        page.family("command_duration_seconds", "Handler duration by command",
+                    self.bot.handler_latency, "command")
+        page.family("middleware_duration_seconds", "Middleware duration",
+                    self.bot.middleware_latency, "middleware")
+        page.family("telegram_request_duration_seconds", "Bot API request duration by method",
+                    self.bot.telegram_latency, "method")
+        page.family("telegram_errors_total", "Failed Bot API requests by method",
+                    self.bot.telegram_errors, "method")
+        page.family("storage_query_duration_seconds",
+                    "DB query duration by StorageService method, other for the rest",
+                    self.db_service.query_latency, "method")
+        page.family("storage_query_errors_total", "Failed DB queries by StorageService method",
+                    self.db_service.query_errors, "method")
+        page.histogram("sync_duration_seconds", "Fixture sync and scoring duration",
+                       self.api.update_latency.snapshot())
+        page.counter("sync_errors_total", "Failed fixture syncs", self.api.update_errors)
+        page.add("leader", "gauge", "1 if process syncs fixtures and scores matches",
+                 float(self.leader.leader))
+        page.stats("sync", self.api.stats())
+
+        db_stats = self.db_service.stats()
+        for replica in db_stats.pop("replicas"):
+            page.stats("db_replica", replica, {"host": replica["host"]})
+        page.stats("db", db_stats)
+        for worker in self.bot.dispatcher.stats():
+            idx = worker.pop("worker")
+            page.stats("dispatcher", worker, {"worker": idx})
+        page.stats("notifier", self.notifier.stats())
+        page.stats("data_api", self.data_api.stats())
+        page.stats("conversations", self.conversations.stats())
+        for name, cache in (("user", self.storage.user_cache),
+                            ("predicted", self.storage.predicted_cache),
+                            ("render", self.bot.render_cache),
+                            ("page", self.bot.page_cache)):
+            page.stats("cache", cache.stats(), {"cache": name})
+        return page.render()
+
+    def stop(self):
+        self.scheduler.stop()
+        self.schedule_refresher.stop()
+        self.bot.stop()
+        self.notifier.stop()
+        self.log_sink.close()
+        self.conversations.close()
+        self.data_api.close()
+        self.leader.release()
+        self.db_service.close()
+
+
+def configure_telegram_api(settings: Settings) -> None:
+    if settings.telegram_api_url:
+        apihelper.API_URL = settings.telegram_api_url.rstrip("/") + "/bot{0}/{1}"
+
+
+def create_status_server(settings: Settings, logger: logging.Logger,
+                         ready: Callable[[], tuple[bool, dict]],
+                         metrics: Callable[[], bytes], port: int = 0) -> Optional[StatusServer]:
+    """
+    :arg: port - listen port, status_port setting is used by default
+    """
+    if settings.status_port == 0:
+        return None
+    server = StatusServer(settings.status_host, port or settings.status_port, logger)
+    server.add_probe("/health", lambda: (True, {"alive": True}))
+    server.add_probe("/ready", ready)
+    server.add_route("/metrics", lambda: (200, PROMETHEUS_CONTENT_TYPE, metrics()))
+    server.start()
+    return server
+
+
+def receive_updates(settings: Settings, logger: logging.Logger,
+                    dispatch: Callable[[Update], None], ready: threading.Event) -> None:
+    """
+    Receives updates via webhook or long polling until shutdown
+    """
+    if settings.webhook_enabled:
+        set_webhook(settings.bot_token, settings.webhook_url, settings.webhook_secret)
+        server = WebhookServer(dispatch,
+                               settings.webhook_url,
+                               settings.webhook_host,
+                               settings.webhook_port,
+                               settings.webhook_secret,
+                               settings.webhook_concurrency,
+                               logger)
+        ready.set()
+        try:
+            server.run()
+        finally:
+            server.close()
+    else:
+        poller = UpdatePoller(telebot.TeleBot(settings.bot_token, threaded=False), dispatch,
+                              logger)
+        poller.start()
+        ready.set()
+        try:
+            poller.wait()
+        finally:
+            # before caller stops handlers, so no update is confirmed without being handled
+            poller.stop()
 
 
 def run(settings: Settings, logger: logging.Logger) -> None:
-    db_service = Db(settings.postgres_dsn, logger)
+    if settings.webhook_enabled and not settings.webhook_secret:
+        # webhook url is public, without secret anyone could post fake updates
+        logger.error("WEBHOOK_SECRET must be set to receive updates via webhook")
+        sys.exit(1)
+
+    configure_telegram_api(settings)
+    if settings.worker_processes > 1:
+        run_front(settings, logger)
+        return
+
+    process = BotProcess(settings, logger)
+    ready = threading.Event()
+    status = create_status_server(settings, logger, lambda: (ready.is_set(), {
+        "ready": ready.is_set(), "leader": process.leader.leader,
+    }), process.metrics)
+
+    # Raise SystemExit on SIGTERM, so buffered logs are flushed on shutdown
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    process.start()
+    try:
+        receive_updates(settings, logger, process.bot.process_update, ready)
+    finally:
+        ready.clear()
+        if status is not None:
+            status.close()
+        process.stop()
+
+
+def run_front(settings: Settings, logger: logging.Logger) -> None:
+    """
+    Front process: receives updates and passes them to handler processes by chat id
+    """
+    pool = WorkerPool(run_worker, (settings,), settings.worker_processes, logger,
+                      settings.handler_queue_size)
+    ready = threading.Event()
+
+    def probe() -> tuple[bool, dict]:
+        workers_ready, details = pool.ready()
+        return ready.is_set() and workers_ready, details
+
+    def metrics() -> bytes:
+        # handler processes serve their own metrics, see run_worker
+        page = PrometheusText("euro_oracle_bot_")
+        for worker in pool.ready()[1]["workers"]:
+            idx = worker.pop("worker")
+            worker.pop("pid")
+            page.stats("worker", worker, {"worker": idx})
+        return page.render()
+
+    status = create_status_server(settings, logger, probe, metrics)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    pool.start()
+    try:
+        receive_updates(settings, logger, pool.dispatch, ready)
+    finally:
+        ready.clear()
+        if status is not None:
+            status.close()
+        pool.stop()
+
+
+# pylint: disable=too-many-arguments
+def run_worker(settings: Settings, shard: int, shards: int, updates: multiprocessing.Queue,
+               ready: multiprocessing.Event, leader: multiprocessing.Value) -> None:
+    """
+    Handler process of multi-process mode, runs until None is received from updates queue.
+    Its metrics are served on status_port + 1 + shard.
+    """
+    logger = log.get_logger("euro_oracle_bot", settings.logger_level)
+    configure_telegram_api(settings)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    def on_leader_change(is_leader: bool):
+        leader.value = int(is_leader)
+
+    process = BotProcess(settings, logger, shard, shards, on_leader_change)
+    status = create_status_server(settings, logger,
+                                  lambda: (ready.is_set(), {"ready": ready.is_set()}),
+                                  process.metrics, settings.status_port + 1 + shard)
+    process.start()
+    ready.set()
+    try:
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            process.bot.process_update(update)
+    finally:
+        ready.clear()
+        if status is not None:
+            status.close()
+        process.stop()
+
+
+def rebuild_standings(settings: Settings, logger: logging.Logger) -> None:
+    db_service = create_db(settings, logger)
     storage = StorageService(db_service, logger)
-    BotService(storage, bot_settings.bot_token, logger)
+    rows = storage.rebuild_standings()
+    logger.info(f"Standings rebuilt for {rows} users")
+    db_service.close()
+
+
+COMMANDS = {
+    "run": run,
+    "rebuild-standings": rebuild_standings,
+}
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Euro 2020 Oracle telegram bot")
+    parser.add_argument("command", nargs="?", default="run", choices=COMMANDS.keys())
+    args = parser.parse_args()
+
     logger_ = log.get_logger("euro_oracle_bot", bot_settings.logger_level)
     logger_.info("Run Euro 2020 Oracle telegram bot")
     logger_.debug("Config: %s", bot_settings.json())
-    run(bot_settings, logger_)
+    COMMANDS[args.command](bot_settings, logger_)
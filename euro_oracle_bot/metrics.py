@@ -0,0 +1,186 @@
+"""
+Metrics primitives
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        """
+        :arg: buckets - sorted upper bounds of histogram buckets
+        """
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self._counts)
+            sum_ = self._sum
+            max_ = self._max
+
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            cumulative.append((bound, total))
+
+        return {
+            "count": total,
+            "sum": sum_,
+            "max": max_,
+            "buckets": cumulative,
+        }
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Family:
+    """
+    Metrics of one kind by label value, created on first use
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        """
+        :arg: factory - creates metric, e.g. Counter or Histogram
+        """
+        self.factory = factory
+        self._children: dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, value: str) -> Any:
+        child = self._children.get(value)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(value, self.factory())
+        return child
+
+    def items(self) -> list[tuple[str, Any]]:
+        with self._lock:
+            return list(self._children.items())
+
+
+class PrometheusText:
+    """
+    Metrics page in Prometheus text exposition format
+    """
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        # name -> (type, help, sample lines)
+        self._metrics: dict[str, tuple[str, str, list[str]]] = {}
+
+    def add(self, name: str, type_: str, help_: str, value: float,
+            labels: Optional[dict] = None):
+        self._lines(name, type_, help_).append(
+            f"{self.prefix}{name}{self._labels(labels)} {self._value(value)}"
+        )
+
+    def counter(self, name: str, help_: str, counter: Counter, labels: Optional[dict] = None):
+        self.add(name, "counter", help_, counter.value, labels)
+
+    def histogram(self, name: str, help_: str, snapshot: dict, labels: Optional[dict] = None):
+        """
+        :arg: snapshot - result of Histogram.snapshot()
+        """
+        lines = self._lines(name, "histogram", help_)
+        for bound, count in snapshot["buckets"]:
+            bucket_labels = {**(labels or {}), "le": self._value(bound)}
+            lines.append(f"{self.prefix}{name}_bucket{self._labels(bucket_labels)} {count}")
+        lines.append(f"{self.prefix}{name}_sum{self._labels(labels)} "
+                     f"{self._value(snapshot['sum'])}")
+        lines.append(f"{self.prefix}{name}_count{self._labels(labels)} {snapshot['count']}")
+
+    def family(self, name: str, help_: str, family: Family, label: str):
+        """
+        Adds every metric of family, label value is put under given label name
+        """
+        for value, metric in family.items():
+            if isinstance(metric, Histogram):
+                self.histogram(name, help_, metric.snapshot(), {label: value})
+            else:
+                self.counter(name, help_, metric, {label: value})
+
+    def stats(self, prefix: str, stats: dict, labels: Optional[dict] = None):
+        """
+        Adds numbers of stats() result as gauges and histogram snapshots as histograms,
+        nested dicts are added with key as name prefix. Lists are skipped.
+        """
+        for key, value in stats.items():
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                if "buckets" in value:
+                    self.histogram(name, "", value, labels)
+                else:
+                    self.stats(name, value, labels)
+            elif isinstance(value, (bool, int, float)):
+                self.add(name, "gauge", "", float(value), labels)
+
+    def render(self) -> bytes:
+        lines = []
+        for name, (type_, help_, samples) in self._metrics.items():
+            if help_:
+                lines.append(f"# HELP {self.prefix}{name} {help_}")
+            lines.append(f"# TYPE {self.prefix}{name} {type_}")
+            lines.extend(samples)
+        lines.append("")
+        return "\n".join(lines).encode()
+
+    def _lines(self, name: str, type_: str, help_: str) -> list[str]:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = (type_, help_, [])
+        return metric[2]
+
+    @staticmethod
+    def _labels(labels: Optional[dict]) -> str:
+        if not labels:
+            return ""
+        pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+        return "{" + pairs + "}"
+
+    @staticmethod
+    def _value(value: float) -> str:
+        if value == float("inf"):
+            return "+Inf"
+        return repr(float(value)) if isinstance(value, float) else str(value)
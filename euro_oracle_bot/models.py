@@ -6,7 +6,8 @@ from services.utils import plural_points
 
 import pytz
 
-from sqlalchemy import Column, String, DateTime, Integer, Boolean, ForeignKey
+from sqlalchemy import Column, String, DateTime, Integer, Boolean, ForeignKey, Index, \
+    UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -33,17 +34,19 @@ MATCH_RESUST_DRAW = 0
 
 USER_STAGE_SIMPLE = 0
 USER_STAGE_ENTER_SCORE = 10
+USER_STAGE_SELECT_MATCH = 20
 
 
 # pylint: disable=too-few-public-methods
 class User(Base):
     __tablename__ = "user"
     id = Column("id", Integer, primary_key=True, autoincrement=True)
-    api_id = Column("api_id", Integer, index=True, nullable=False)
+    api_id = Column("api_id", Integer, index=True, unique=True, nullable=False)
     username = Column("username", String, nullable=True)
     full_name = Column("full_name", String, nullable=True)
     chat_stage = Column("chat_stage", Integer, nullable=True)
     chat_stage_payload = Column("chat_stage_payload", String, nullable=True)
+    chat_stage_updated = Column("chat_stage_updated", DateTime, nullable=True)
     created = Column("created", DateTime, nullable=True)
     notifications_on = Column("notifications_on", Boolean, nullable=True)
 
@@ -82,7 +85,7 @@ class UserLog(Base):
 class Team(Base):
     __tablename__ = "team"
     id = Column("id", Integer, primary_key=True, autoincrement=True)
-    api_id = Column("api_id", Integer, nullable=False)
+    api_id = Column("api_id", Integer, index=True, unique=True, nullable=False)
     title = Column("title", String, nullable=False)
     rus_title = Column("rus_title", String, nullable=True)
     alias = Column("alias", String, nullable=True)
@@ -95,8 +98,8 @@ class Team(Base):
 class Match(Base):
     __tablename__ = "match"
     id = Column("id", Integer, primary_key=True, autoincrement=True)
-    api_id = Column("api_id", Integer, nullable=False)
-    datetime = Column("datetime", DateTime, nullable=False)
+    api_id = Column("api_id", Integer, index=True, unique=True, nullable=False)
+    datetime = Column("datetime", DateTime, nullable=False, index=True)
     stage = Column("stage", Integer, nullable=False)
     group = Column("group", String, nullable=False, index=True)
     stadium = Column("stadium", String, nullable=True)
@@ -165,8 +168,10 @@ class Match(Base):
 # pylint: disable=too-few-public-methods
 class Prediction(Base):
     __tablename__ = "prediction"
+    # unique key also serves lookups by user_id
+    __table_args__ = (UniqueConstraint("user_id", "match_id", name="uq_prediction_user_match"),)
     id = Column("id", Integer, primary_key=True, autoincrement=True)
-    user_id = Column("user_id", Integer, ForeignKey(User.id, ondelete="CASCADE"), index=True)
+    user_id = Column("user_id", Integer, ForeignKey(User.id, ondelete="CASCADE"))
     user: User = relationship("User")
     match_id = Column("match_id", Integer, ForeignKey(Match.id, ondelete="CASCADE"), index=True)
     match: Match = relationship("Match")
@@ -190,6 +195,23 @@ class Prediction(Base):
         return get_match_result(self.home_goals, self.away_goals)
 
 
+# pylint: disable=too-few-public-methods
+class Standing(Base):
+    """
+    Leaderboard row, points are added when match result is processed
+    """
+    __tablename__ = "standing"
+    user_id = Column("user_id", Integer, ForeignKey(User.id, ondelete="CASCADE"),
+                     primary_key=True)
+    user: User = relationship("User")
+    points = Column("points", Integer, nullable=False, default=0)
+    # copy of user.created, used as tie-break in leaderboard index
+    user_created = Column("user_created", DateTime, nullable=True)
+
+
+Index("ix_standing_rank", Standing.points.desc(), Standing.user_created)
+
+
 class MatchFilter(BaseModel):
     group: Optional[str] = None
     datetime: Optional[datetime] = None
@@ -241,6 +263,14 @@ def get_match_status_by_api_value(status: str) -> int:
     }.get(status, MATCH_STATUS_NOT_STARTED)
 
 
+def parse_api_datetime(value: str) -> datetime:
+    # elenasport.io dates are UTC, stored as naive datetime
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(pytz.utc).replace(tzinfo=None)
+    return parsed
+
+
 def get_match_result(home_goals: int, away_goals: int) -> int:
     if home_goals > away_goals:
         return MATCH_RESULT_HOME_WIN
@@ -1,178 +1,301 @@
 import json
-import threading
-import http.client
+import time
+import hashlib
 from logging import Logger
+from datetime import datetime, timedelta
+from typing import Optional
 
-from telebot.apihelper import ApiTelegramException
-
+from metrics import Counter, Histogram
 from models import Team, Match, Prediction
 from models import get_group_by_api_stage_id, get_stage_by_api_stage_id, \
-    get_match_status_by_api_value
-from models import MATCH_STATUS_FINISHED
+    get_match_status_by_api_value, parse_api_datetime
+from models import MATCH_STATUS_IN_PROGRESS, MATCH_STATUS_FINISHED
 from .storage import StorageService
-from .bot import BotService
+from .notifier import NotificationDispatcher
+from .dataapi import DataApiClient, DataApiError
+from .snapshot import FixtureSnapshot
 from .utils import plural_points
+from .render import render_score
+
+# match columns which are updated from fixtures until match is processed
+MATCH_SYNC_FIELDS = ("datetime", "status", "home_goals_90", "away_goals_90", "home_goals_total",
+                     "away_goals_total", "home_goals_pen", "away_goals_pen")
+
+FIXTURES_PATH = "/v2/seasons/797/fixtures?from={}"
+# first day of UEFA EURO 2020
+SEASON_START = datetime(2021, 6, 11)
+
+SYNC_IDLE_INTERVAL = 3600
+SYNC_LIVE_INTERVAL = 60
+SYNC_RESULT_INTERVAL = 30
+SYNC_MIN_INTERVAL = 15
+# regular time with breaks, final whistle is expected after that
+MATCH_DURATION = timedelta(minutes=115)
+# extra time and penalties, results are polled often until that
+MATCH_MAX_DURATION = timedelta(minutes=170)
+# matches which are not finished long after kickoff (e.g. postponed) don't speed up polling
+MATCH_STALE_AFTER = timedelta(hours=12)
 
 
+# pylint: disable=too-many-instance-attributes
 class ApiService:
+    # pylint: disable=too-many-arguments
     def __init__(self,
                  storage: StorageService,
-                 bot: BotService,
-                 token: str,
-                 logger: Logger):
+                 notifier: NotificationDispatcher,
+                 client: DataApiClient,
+                 logger: Logger,
+                 snapshot: Optional[FixtureSnapshot] = None,
+                 snapshot_max_age: float = 6 * 3600):
         """
         :arg: storage - storage service
-        :arg: bot - tg bot instance
-        :arg: token - elenasport.io API token
+        :arg: notifier - notification dispatcher
+        :arg: client - elenasport.io API client
         :arg: logger - logger object
+        :arg: snapshot - on-disk snapshot of last good fixtures, None disables it
+        :arg: snapshot_max_age - seconds after last good fetch when fixtures are stale
         """
         self.storage = storage
         self.logger = logger
-        self.api_token = token
-        self.bot = bot
+        self.client = client
+        self.notifier = notifier
+        self.snapshot = snapshot
+        self.snapshot_max_age = snapshot_max_age
+        # last good payload of every fetched fixture by api id
+        self.fixtures: dict[int, dict] = {}
+        # fixture api id -> hash of fixture payload at last successful reconcile
+        self.fixture_hashes: dict[int, str] = {}
+        # unix time of last successful fetch, including not modified responses
+        self.last_fetch = 0.0
+        # snapshot is loaded by first sync, which runs only in leader process
+        self._snapshot_loaded = False
+        self.update_latency = Histogram((0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+        self.update_errors = Counter()
+
+    def load_snapshot(self):
+        """
+        Restores request validators and fixture hashes from snapshot, so first sync after
+        restart is conditional and unchanged fixtures are not reconciled again.
+        Schedule is always served from DB: snapshot is saved after fixtures are reconciled,
+        so DB already has them or newer rows and is not written here.
+        """
+        self._snapshot_loaded = True
+        if self.snapshot is None:
+            return
+        data = self.snapshot.load()
+        if data is None:
+            return
+
+        fixtures = data["fixtures"]
+        self.fixtures = {fixture["id"]: fixture for fixture in fixtures}
+        self.fixture_hashes = {fixture["id"]: self._fixture_hash(fixture) for fixture in fixtures}
+        self.client.set_validators(data["validators"])
+        self.last_fetch = self.snapshot.saved_at
+        self.logger.info(f"Loaded {len(fixtures)} fixtures from snapshot, "
+                         f"age {self.fixtures_age():.0f}s")
 
     def update(self):
+        with self.update_latency.time():
+            try:
+                self._update()
+            except Exception:
+                self.update_errors.inc()
+                raise
+
+    def _update(self):
+        if not self._snapshot_loaded:
+            self.load_snapshot()
+        validators = self.client.get_validators()
+        last_fetch = self.last_fetch
         fixtures = self._get_all_fixtures()
-        for fixture in fixtures:
-            match = self.storage.get_match_by_api_id(fixture["id"])
-            if match is None:
-                match = Match()
-                match.api_id = fixture["id"]
-                match.group = get_group_by_api_stage_id(fixture["idStage"])
-                match.stage = get_stage_by_api_stage_id(fixture["idStage"], fixture["round"])
-                match.stadium = fixture["venueName"]
+        if fixtures is None:
+            if self.is_stale():
+                self.logger.warning(f"fixtures are stale, last good fetch "
+                                    f"{self.fixtures_age():.0f}s ago")
+        elif fixtures:
+            hashes = {fixture["id"]: self._fixture_hash(fixture) for fixture in fixtures}
+            changed = [fixture for fixture in fixtures
+                       if self.fixture_hashes.get(fixture["id"]) != hashes[fixture["id"]]]
+            if changed:
+                try:
+                    self.reconcile(changed)
+                except Exception:
+                    # validators of unsaved response would turn next fetch into 304
+                    # and the change would never be saved
+                    self.client.set_validators(validators)
+                    self.last_fetch = last_fetch
+                    raise
+            self.logger.debug(f"{len(fixtures) - len(changed)} fixtures skipped by hash")
+            self.fixture_hashes.update(hashes)
+            self.fixtures.update((fixture["id"], fixture) for fixture in fixtures)
+            if self.snapshot is not None:
+                self.snapshot.save(list(self.fixtures.values()), self.client.get_validators())
+
+        for match in self.storage.get_unprocessed_finished_matches():
+            self.process_match_result(match)
+
+    def fixtures_age(self) -> float:
+        """
+        Seconds since last successful fetch, infinity if there was none
+        """
+        if not self.last_fetch:
+            return float("inf")
+        return max(time.time() - self.last_fetch, 0.0)
+
+    def is_stale(self) -> bool:
+        return self.fixtures_age() > self.snapshot_max_age
+
+    def stats(self) -> dict:
+        return {
+            "fixtures": len(self.fixtures),
+            "fixtures_age": self.fixtures_age(),
+            "fixtures_stale": self.is_stale(),
+        }
 
+    def next_sync_delay(self) -> float:
+        """
+        Seconds until next sync: rare when no match is near, often while matches are played
+        and right after expected final whistle, until results are processed
+        """
+        now = datetime.utcnow()
+        delay = SYNC_IDLE_INTERVAL
+        for match in self.storage.get_all_matches():
             if match.processed:
                 continue
 
-            match.team_home_id = self.process_team(fixture, "home")
-            match.team_away_id = self.process_team(fixture, "away")
-            match.datetime = fixture["date"]
-            match.status = get_match_status_by_api_value(fixture["status"])
-            match.home_goals_90 = fixture["team_home_90min_goals"]
-            match.away_goals_90 = fixture["team_away_90min_goals"]
-            match.home_goals_total = fixture["team_home_ET_goals"] + \
-                                     fixture["team_home_90min_goals"]
-            match.away_goals_total = fixture["team_away_ET_goals"] + \
-                                     fixture["team_away_90min_goals"]
-            match.home_goals_pen = fixture["team_home_PEN_goals"]
-            match.away_goals_pen = fixture["team_away_PEN_goals"]
-            self.storage.create_or_update_match(match)
-            if match.status == MATCH_STATUS_FINISHED and not match.processed:
-                self.process_match_result(match)
-
-        threading.Timer(3600, self.update).start()
-
-    def process_match_result(self, match: Match):
-        predictions = self.storage.get_match_predictions(match.id)
-        match_result = match.get_result()
-        for pred in predictions:
-            pred_result = pred.get_result()
-            diff = abs(match.home_goals_90 - match.away_goals_90)
-            if diff >= 3:
-                if match.home_goals_90 == pred.home_goals and \
-                        match.away_goals_90 == pred.away_goals:
-                    pred.points = 5
-                elif match_result == pred_result:
-                    if diff == abs(pred.home_goals - pred.away_goals):
-                        pred.points = 4
-                    else:
-                        pred.points = 1
+            since_kickoff = now - match.datetime
+            if since_kickoff < timedelta(0):
+                delay = min(delay, -since_kickoff.total_seconds())
+            elif since_kickoff > MATCH_STALE_AFTER:
+                continue
+            elif match.status == MATCH_STATUS_FINISHED:
+                delay = min(delay, SYNC_RESULT_INTERVAL)
+            elif MATCH_DURATION <= since_kickoff <= MATCH_MAX_DURATION:
+                delay = min(delay, SYNC_RESULT_INTERVAL)
+            elif since_kickoff < MATCH_DURATION or match.status == MATCH_STATUS_IN_PROGRESS:
+                delay = min(delay, SYNC_LIVE_INTERVAL)
             else:
-                if match.home_goals_90 == pred.home_goals and \
-                        match.away_goals_90 == pred.away_goals:
-                    pred.points = 3
-                elif match_result == pred_result:
-                    if diff == abs(pred.home_goals - pred.away_goals):
-                        pred.points = 2
-                    else:
-                        pred.points = 1
-
-            if pred.user.notifications_on:
-                self._notify_user(pred)
-
-            if pred.points > 0:
-                self.storage.create_or_update_prediction(pred)
-
-        match.processed = True
-        self.storage.create_or_update_match(match)
-
-    def process_team(self, fixture: dict, prefix: str) -> int:
-        team = self.storage.get_team_by_api_id(fixture["id" + prefix.title()])
-        if team is not None:
-            return team.id
-
-        team = Team()
-        team.api_id = fixture["id" + prefix.title()]
-        team.title = fixture[prefix + "Name"]
-        team.group = get_group_by_api_stage_id(fixture["idStage"])
-        return self.storage.create_or_update_team(team)
-
-    def _notify_user(self, pred: Prediction):
-        match = pred.match
-        msg = "Завершился один из матчей с вашим прогнозом!\n\n" \
-              f"{match.str_score()}\n\n" \
-              f"Ваш прогноз: {pred.home_goals} - {pred.away_goals}\n" \
-              f"Вы заработали *{plural_points(pred.points)}*\n\n" \
+                # result is late, don't poll too often
+                delay = min(delay, SYNC_LIVE_INTERVAL * 5)
 
-        try:
-            self.bot.send_buttons_by_id(pred.user.api_id, msg)
-        except ApiTelegramException:
-            return
+        return max(delay, SYNC_MIN_INTERVAL)
 
-    def _get_all_fixtures(self) -> list:
-        auth_token = self._get_auth_token(self.api_token)
-        if auth_token == "":
-            self.logger.error("auth token not set")
-            return []
+    def reconcile(self, fixtures: list[dict]):
+        """
+        Diffs fixtures against stored matches and teams and saves only changed rows
+        """
+        teams = {team.api_id: team for team in self.storage.get_all_teams()}
+        team_api_ids = {team.id: team.api_id for team in teams.values()}
+        matches = {match.api_id: match for match in self.storage.get_all_matches()}
 
-        all_fixtures = []
-        conn = http.client.HTTPSConnection("football.elenasport.io")
-        headers = {
-            'Authorization': "Bearer " + auth_token,
-        }
-        conn.request("GET", "/v2/seasons/797/fixtures?from=2021-07-06", headers=headers)
-        try:
-            response = conn.getresponse()
-        except http.client.ResponseNotReady as exception:
-            self.logger.error("failed to send get request to elenasport.io: " + str(exception))
-            return []
+        new_teams = []
+        new_matches = []
+        changed_matches = []
+        unchanged = 0
+        for fixture in fixtures:
+            for prefix in ("home", "away"):
+                api_id = fixture["id" + prefix.title()]
+                if api_id not in teams:
+                    teams[api_id] = Team(api_id=api_id, title=fixture[prefix + "Name"],
+                                         group=get_group_by_api_stage_id(fixture["idStage"]))
+                    new_teams.append(teams[api_id])
+
+            row = self._match_row(fixture)
+            match = matches.get(fixture["id"])
+            if match is None:
+                new_matches.append(row)
+                continue
 
-        raw_data = response.read()
-        data = json.loads(raw_data)
+            stored = {field: getattr(match, field) for field in MATCH_SYNC_FIELDS}
+            stored["team_home_api_id"] = team_api_ids.get(match.team_home_id)
+            stored["team_away_api_id"] = team_api_ids.get(match.team_away_id)
+            if match.processed or stored == {field: row[field] for field in stored}:
+                unchanged += 1
+                continue
 
-        if "data" not in data:
-            self.logger.error("Missing data field in elenasport.io response: " + str(raw_data))
-            return []
+            changed_matches.append(row)
+
+        if new_teams or new_matches or changed_matches:
+            self.storage.save_fixtures(new_teams, new_matches + changed_matches)
+        self.logger.info(f"Fixtures synced: {len(new_matches)} inserted, "
+                         f"{len(changed_matches)} updated, {unchanged} unchanged, "
+                         f"{len(new_teams)} new teams")
+
+    def fixtures_from(self) -> datetime:
+        """
+        Start of fetch window: kickoff of the first not processed match,
+        or of the last match if all are processed
+        """
+        matches = self.storage.get_all_matches()
+        unprocessed = [match.datetime for match in matches if not match.processed]
+        if unprocessed:
+            return min(unprocessed)
+        if matches:
+            return max(match.datetime for match in matches)
 
-        all_fixtures += data["data"]
+        return SEASON_START
 
-        return all_fixtures
+    @staticmethod
+    def _fixture_hash(fixture: dict) -> str:
+        return hashlib.sha1(json.dumps(fixture, sort_keys=True).encode()).hexdigest()
 
-    def _get_auth_token(self, api_token: str) -> str:
-        conn = http.client.HTTPSConnection("oauth2.elenasport.io")
-        headers = {
-            "Authorization": "Basic " + api_token,
-            "Content-Type": "application/x-www-form-urlencoded"
+    @staticmethod
+    def _match_row(fixture: dict) -> dict:
+        return {
+            "api_id": fixture["id"],
+            "group": get_group_by_api_stage_id(fixture["idStage"]),
+            "stage": get_stage_by_api_stage_id(fixture["idStage"], fixture["round"]),
+            "stadium": fixture["venueName"],
+            "team_home_api_id": fixture["idHome"],
+            "team_away_api_id": fixture["idAway"],
+            "datetime": parse_api_datetime(fixture["date"]),
+            "status": get_match_status_by_api_value(fixture["status"]),
+            "home_goals_90": fixture["team_home_90min_goals"],
+            "away_goals_90": fixture["team_away_90min_goals"],
+            "home_goals_total": fixture["team_home_ET_goals"] + fixture["team_home_90min_goals"],
+            "away_goals_total": fixture["team_away_ET_goals"] + fixture["team_away_90min_goals"],
+            "home_goals_pen": fixture["team_home_PEN_goals"],
+            "away_goals_pen": fixture["team_away_PEN_goals"],
         }
-        payload = "grant_type=client_credentials"
 
-        conn.request("POST", "/oauth2/token", payload, headers)
-        try:
-            response = conn.getresponse()
-        except http.client.ResponseNotReady as exception:
-            self.logger.error("failed to send auth request to elenasport.io: " + str(exception))
-            return ""
+    def process_match_result(self, match: Match):
+        predictions = self.storage.score_match(match)
+        if not predictions:
+            return
+
+        # reload match with teams for notification text
+        match = self.storage.get_match(match.id)
+        for pred in predictions:
+            self._notify_user(match, pred)
 
-        raw_data = response.read()
-        data = json.loads(raw_data)
+    def _notify_user(self, match: Match, pred: Prediction):
+        msg = "Завершился один из матчей с вашим прогнозом!\n\n" \
+              f"{render_score(match)}\n\n" \
+              f"Ваш прогноз: {pred.home_goals} - {pred.away_goals}\n" \
+              f"Вы заработали *{plural_points(pred.points)}*\n\n" \
 
-        if "error" in data:
-            self.logger.error("get elenasport.io access token error: " + data["error"])
-            return ""
+        self.notifier.notify(pred.user.api_id, msg)
 
-        if "access_token" not in data:
-            self.logger.error("missing access token field in elenasport.io response: " + str(data))
-            return ""
+    def _get_all_fixtures(self) -> Optional[list]:
+        """
+        Returns changed fixtures, empty list if not modified or None if fetch failed
+        """
+        # one day margin, as API dates may be in other timezone
+        from_date = (self.fixtures_from() - timedelta(days=1)).strftime("%Y-%m-%d")
+        try:
+            data = self.client.get_json_if_modified(FIXTURES_PATH.format(from_date))
+        except DataApiError as exc:
+            self.logger.error(f"failed to get fixtures from elenasport.io: {str(exc)}")
+            return None
+
+        if data is None:
+            self.logger.debug("fixtures not modified")
+            self.last_fetch = time.time()
+            return []
+
+        if "data" not in data:
+            self.logger.error("Missing data field in elenasport.io response: " + str(data))
+            return None
 
-        return data["access_token"]
+        self.last_fetch = time.time()
+        return data["data"]
@@ -1,35 +1,76 @@
-import os
+import functools
 import threading
-
+import time
 from logging import Logger
-from datetime import datetime
+from datetime import datetime, date
+from typing import Iterable, Optional, Union
 
 import telebot
-from telebot.types import Update, ReplyKeyboardMarkup
+from telebot.types import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, \
+    InlineKeyboardButton, CallbackQuery
 from telebot import apihelper
 
-from models import User, UserLog, Prediction, MatchFilter
-from models import USER_STAGE_SIMPLE, USER_STAGE_ENTER_SCORE
+from metrics import Counter, Histogram, Family
+from models import UserLog, MatchFilter
+from models import USER_STAGE_ENTER_SCORE, USER_STAGE_SELECT_MATCH
 from .utils import parse_group_name, parse_stage, parse_score, extract_arg, plural_points
 
 from .storage import StorageService
+from .dispatcher import UpdateDispatcher
+from .logsink import UserLogSink
+from .conversation import ConversationStore
+from .cache import TTLCache
+from .render import LOCAL_TZ_NAME, render_match, render_prediction, render_user
+from .message import MessageBuilder, split_message
 
 apihelper.ENABLE_MIDDLEWARE = True
 
+PREDICTIONS_PAGE_SIZE = 10
+PREDICTIONS_CALLBACK_PREFIX = "me:"
+
 
+# pylint: disable=too-many-public-methods,too-many-instance-attributes
 class BotService:
-    def __init__(self, storage: StorageService, token: str, logger: Logger):
+    # pylint: disable=too-many-arguments
+    def __init__(self, storage: StorageService, log_sink: UserLogSink,
+                 conversations: ConversationStore, token: str,
+                 logger: Logger, workers: int = 4, max_queue: int = 0):
         """
         :arg: storage - storage service
+        :arg: log_sink - user log sink
+        :arg: conversations - conversation state store
         :arg: token - Telegram bot token
         :arg: logger - logger object
+        :arg: workers - number of handler workers, updates are sharded by chat id
+        :arg: max_queue - max queued updates per worker, 0 means unbounded
         """
         self.storage = storage
+        self.log_sink = log_sink
+        self.conversations = conversations
         self.logger = logger
-        self.bot = telebot.TeleBot(token, parse_mode="Markdown")
-
-        self.bot.add_middleware_handler(self.user_middleware)
-        self.bot.add_middleware_handler(self.log_middleware)
+        # Handlers are run by dispatcher workers, so TeleBot must not use its own pool
+        self.bot = telebot.TeleBot(token, parse_mode="Markdown", threaded=False)
+        self.dispatcher = UpdateDispatcher(self._handle_update, workers, logger, max_queue)
+        # (command, filter, local date) -> (schedule version, rendered message chunks)
+        self.render_cache = TTLCache(max_size=256, ttl=24 * 3600)
+        # user id -> (schedule version, {page cursor: rendered page})
+        self.page_cache = TTLCache(max_size=10000, ttl=600)
+        # command (or handler name for non-command handlers) -> handler duration
+        self.handler_latency = Family(Histogram)
+        self.middleware_latency = Family(Histogram)
+        # Bot API method -> request duration and errors
+        self.telegram_latency = Family(Histogram)
+        self.telegram_errors = Family(Counter)
+        # Telegram calls of update being handled, they are made after its transaction commits
+        self._outbox = threading.local()
+
+        self.bot.add_middleware_handler(self._timed(self.user_middleware,
+                                                    self.middleware_latency))
+        self.bot.add_middleware_handler(self._timed(self.log_middleware,
+                                                    self.middleware_latency))
+        # reply in the middle of conversation is handled before commands, as next step is
+        self.bot.add_message_handler(self._build_handler_dict(self.continue_conversation,
+                                                              func=self._in_conversation))
         self.bot.add_message_handler(self._build_handler_dict(self.all_matches,
                                                               commands=["matches"]))
         self.bot.add_message_handler(self._build_handler_dict(self.matches_today,
@@ -55,9 +96,40 @@ class BotService:
         self.bot.add_message_handler(self._build_handler_dict(self.notifications_disable,
                                                               commands=["notificationsoff"]))
         self.bot.add_message_handler(self._build_handler_dict(self.unknown_message))
+        self.bot.add_callback_query_handler({
+            'function': self._timed(self.user_predictions_page, self.handler_latency),
+            'filters': {'func': lambda call: (call.data or "").startswith(
+                PREDICTIONS_CALLBACK_PREFIX)}
+        })
 
-        bot_thread = threading.Thread(target=self.bot.infinity_polling)
-        bot_thread.start()
+    def start(self):
+        """
+        Starts handling updates passed to process_update, they are received
+        by UpdatePoller or WebhookServer
+        """
+        self.dispatcher.start()
+
+    def stop(self):
+        self.dispatcher.stop()
+
+    def process_update(self, update: Update):
+        self.dispatcher.dispatch(update)
+
+    def _handle_update(self, update: Update):
+        outbox = []
+        self._outbox.calls = outbox
+        try:
+            # middlewares and handlers of one update share one transaction
+            with self.storage.unit_of_work():
+                self.bot.process_new_updates([update])
+            self._outbox.calls = None
+            for call in outbox:
+                call()
+        finally:
+            self._outbox.calls = None
+            log = getattr(update.message, "log", None)
+            if log is not None:
+                self.log_sink.put(log)
 
     def user_middleware(self, _, update: Update):
         try:
@@ -65,18 +137,20 @@ class BotService:
         except AttributeError:
             return
 
+        from_user = update.message.from_user
         if user is None:
-            user = User()
-            user.api_id = update.message.from_user.id
-            user.created = datetime.utcnow()
-
-        user.username = update.message.from_user.username
-        user.full_name = update.message.from_user.full_name
-        self.storage.create_or_update_user(user)
+            user = self.storage.upsert_user(from_user.id, from_user.username,
+                                            from_user.full_name)
+        else:
+            user.username = from_user.username
+            user.full_name = from_user.full_name
+            self.storage.create_or_update_user(user)
 
         update.message.user = user
 
     def log_middleware(self, _, update: Update):
+        if update.message is None:
+            return
         try:
             user = update.message.user
         except AttributeError:
@@ -84,27 +158,20 @@ class BotService:
             return
 
         log = UserLog(user.id, user.username, update.message.text)
-        self.storage.create_or_update_userlog(log)
+        log.created = datetime.utcnow()
         update.message.log = log
 
     def all_matches(self, message):
-        local_tz = os.getenv("TZ", "Europe/Moscow")
-        matches = self.storage.find_matches(MatchFilter())
-        msg = f"*Все матчи UEFA EURO 2020* (указано время {local_tz})\n\n"
-        for match in matches:
-            msg += f"{match}\n"
-
+        msg = self._render_matches("matches", MatchFilter(),
+                                   "*Все матчи UEFA EURO 2020* "
+                                   f"(указано время {LOCAL_TZ_NAME})\n\n")
         self._send_response(message.chat.id, msg, message.log)
 
     def matches_today(self, message):
         filter_ = MatchFilter()
         filter_.datetime = datetime.utcnow()
-        matches = self.storage.find_matches(filter_)
-
-        msg = "*Матчи UEFA EURO 2020 за сегодня*\n\n"
-        for match in matches:
-            msg += f"{match}\n"
-
+        msg = self._render_matches("matchestoday", filter_,
+                                   "*Матчи UEFA EURO 2020 за сегодня*\n\n")
         self._send_response(message.chat.id, msg, message.log)
 
     def matches_group_select(self, message):
@@ -112,8 +179,8 @@ class BotService:
         if len(group) == 0:
             markup = ReplyKeyboardMarkup(one_time_keyboard=True)
             markup.add("A", "B", "C", "D", "E", "F")
-            msg = self.bot.reply_to(message, "Выберите или укажите группу:", reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.matches_group)
+            self._after_commit(self._ask, message, "Выберите или укажите группу:", markup,
+                               self.matches_group)
             return
 
         message.text = group[0]
@@ -122,17 +189,13 @@ class BotService:
     def matches_group(self, message):
         group = parse_group_name(message.text)
         if group == "":
-            self.bot.send_message(message.chat.id, "Группа не найдена")
+            self._send_response(message.chat.id, "Группа не найдена", message.log)
             return
 
         filter_ = MatchFilter()
         filter_.group = group
-        matches = self.storage.find_matches(filter_)
-
-        msg = f"*Матчи группы {group} на UEFA EURO 2020*\n\n"
-        for match in matches:
-            msg += f"{match}\n"
-
+        msg = self._render_matches("matchesgroup", filter_,
+                                   f"*Матчи группы {group} на UEFA EURO 2020*\n\n")
         self._send_response(message.chat.id, msg, message.log)
 
     def matches_stage_select(self, message):
@@ -140,8 +203,8 @@ class BotService:
         if len(stage) == 0:
             markup = ReplyKeyboardMarkup(one_time_keyboard=True)
             markup.add("1 тур", "2 тур", "3 тур", "1/8 финала", "1/4 финала", "1/2 финала", "Финал")
-            msg = self.bot.reply_to(message, "Выберите или укажите стадию:", reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.matches_stage)
+            self._after_commit(self._ask, message, "Выберите или укажите стадию:", markup,
+                               self.matches_stage)
             return
 
         message.text = stage[0]
@@ -150,18 +213,25 @@ class BotService:
     def matches_stage(self, message):
         stage = parse_stage(message.text)
         if stage == "":
-            self.bot.send_message(message.chat.id, "Стадия не найдена")
+            self._send_response(message.chat.id, "Стадия не найдена", message.log)
             return
 
         filter_ = MatchFilter()
         filter_.stage = stage
-        matches = self.storage.find_matches(filter_)
+        msg = self._render_matches("matchesstage", filter_,
+                                   "*Матчи выбранной стадии на UEFA EURO 2020*\n\n")
+        self._send_response(message.chat.id, msg, message.log)
 
-        msg = "*Матчи выбранной стадии на UEFA EURO 2020*\n\n"
-        for match in matches:
-            msg += f"{match}\n"
+    def continue_conversation(self, message):
+        state = self.conversations.get(message.user.id)
+        if state is not None and state.stage == USER_STAGE_SELECT_MATCH:
+            self.conversations.clear(message.user.id)
+            return self.create_predict_enter_score(message)
+        return self.create_predict(message)
 
-        self._send_response(message.chat.id, msg, message.log)
+    def _in_conversation(self, message) -> bool:
+        user = getattr(message, "user", None)
+        return user is not None and self.conversations.get(user.id) is not None
 
     def create_predict_next_match(self, message):
         match = self.storage.get_next_match_prediction(message.user.id)
@@ -177,8 +247,9 @@ class BotService:
     def create_predict_match_select(self, message):
         match_id = extract_arg(message.text)
         if len(match_id) == 0:
-            msg = self.bot.reply_to(message, "Укажите ID матча:")
-            self.bot.register_next_step_handler(msg, self.create_predict_enter_score)
+            self.conversations.set(message.user.id, USER_STAGE_SELECT_MATCH)
+            self._send_response(message.chat.id, "Укажите ID матча:", message.log,
+                                reply_to_message_id=message.message_id)
             return
 
         message.text = match_id[0]
@@ -202,27 +273,22 @@ class BotService:
                                 message.log)
             return
 
-        user = message.user
-        user.chat_stage = USER_STAGE_ENTER_SCORE
-        user.chat_stage_payload = match.id
-        self.storage.create_or_update_user(user)
+        self.conversations.set(message.user.id, USER_STAGE_ENTER_SCORE, str(match.id))
 
-        msg_text = f"Укажите счет матча\n{str(match)}\n\n" \
+        msg_text = f"Укажите счет матча\n{render_match(match)}\n\n" \
                    f"*Прогнозы принимаются на результат основного времени*"
-        msg = self._send_response(message.chat.id, msg_text, message.log)
-        self.bot.register_next_step_handler(msg, self.create_predict)
+        self._send_response(message.chat.id, msg_text, message.log)
 
     def create_predict(self, message):
         user = message.user
-        if user.chat_stage != USER_STAGE_ENTER_SCORE:
+        state = self.conversations.get(user.id)
+        if state is None or state.stage != USER_STAGE_ENTER_SCORE:
             self._send_response(message.chat.id, "Матч не найден", message.log)
             return
 
-        user = message.user
-        user.chat_stage = USER_STAGE_SIMPLE
-        self.storage.create_or_update_user(user)
+        self.conversations.clear(user.id)
 
-        match = self.storage.get_match(message.user.chat_stage_payload)
+        match = self.storage.get_match(state.payload)
         if match is None:
             self._send_response(message.chat.id, "Матч не найден", message.log)
             return
@@ -232,50 +298,102 @@ class BotService:
             self._send_response(message.chat.id, "Неверный формат счета", message.log)
             return
 
-        prediction = self.storage.find_prediction(user.id, match.id)
-        if prediction is None:
-            prediction = Prediction()
-            prediction.user_id = user.id
-            prediction.match_id = match.id
-            prediction.points = 0
-            prediction.match = match
-
-        if prediction.match.datetime <= datetime.utcnow():
+        if match.datetime <= datetime.utcnow():
             self._send_response(message.chat.id, "Прогнозы на данный матч больше не принимаются",
                                 message.log)
             return
 
-        prediction.home_goals = scores[1]
-        prediction.away_goals = scores[2]
-        self.storage.create_or_update_prediction(prediction)
-
-        msg = f"Прогноз принят\n{match.team_home.title} {scores[1]} - {scores[2]} " \
-              f"{match.team_away.title}\n\n"
-        msg += "Для ввода прогноза на следующий матч, введите /predict\n"
-        msg += "Для просмотра своих прогнозов, введите /me"
+        self.storage.upsert_prediction(user.id, match.id, scores[1], scores[2])
+        self.page_cache.delete(user.id)
 
-        message.log.response = msg[0:255]
-        self.storage.create_or_update_userlog(message.log)
+        msg = MessageBuilder()
+        msg.add(f"Прогноз принят\n{match.team_home.title} {scores[1]} - {scores[2]} "
+                f"{match.team_away.title}\n\n")
+        msg.add("Для ввода прогноза на следующий матч, введите /predict\n")
+        msg.add("Для просмотра своих прогнозов, введите /me")
 
-        return self._send_buttons(message, msg)
+        return self._send_buttons(message, msg.chunks())
 
     def get_user_predictions(self, message):
-        predictions = self.storage.get_user_predictions(message.user.id)
-        msg = "*Ваши прогнозы на матчи UEFA EURO 2020*\n\n"
-        total_points = 0
-        for prediction in predictions:
-            total_points += prediction.points
-            msg += f"{prediction}\n"
+        msg, markup = self._render_predictions_page(message.user.id, after=0)
+        self._send_response(message.chat.id, msg, message.log, markup, message.message_id)
 
-        msg += f"\n*ВСЕГО ОЧКОВ: {total_points}*\n\n"
+    def user_predictions_page(self, call: CallbackQuery):
+        user = self.storage.get_user_by_api_id(call.from_user.id)
+        direction, _, cursor = call.data[len(PREDICTIONS_CALLBACK_PREFIX):].partition(":")
 
-        msg += "Для ввода прогноза на следующий матч, введите /predict\n"
-        msg += "Для просмотра своих прогнозов, введите /me\n\n"
+        if user is None or call.message is None or not cursor.isdigit():
+            self._after_commit(self._show_predictions_page, call)
+            return
+
+        log = UserLog(user.id, user.username, call.data)
+        log.created = datetime.utcnow()
+        self.log_sink.put(log)
 
-        message.log.response = msg[0:255]
-        self.storage.create_or_update_userlog(message.log)
+        if direction == "p":
+            msg, markup = self._render_predictions_page(user.id, before=int(cursor))
+        else:
+            msg, markup = self._render_predictions_page(user.id, after=int(cursor))
+        self._after_commit(self._show_predictions_page, call, msg, markup)
 
-        return self._send_buttons_split(message, msg)
+    def _show_predictions_page(self, call: CallbackQuery, msg: Optional[str] = None,
+                               markup: Optional[InlineKeyboardMarkup] = None):
+        try:
+            if msg is not None:
+                self._telegram("editMessageText", self.bot.edit_message_text, msg,
+                               call.message.chat.id, call.message.message_id,
+                               reply_markup=markup)
+            self._telegram("answerCallbackQuery", self.bot.answer_callback_query, call.id)
+        except apihelper.ApiException as exc:
+            self.logger.error(f"failed to show predictions page: {str(exc)}")
+
+    def _render_predictions_page(self, user_id: int, after: int = 0,
+                                 before: int = None) -> tuple[str, InlineKeyboardMarkup]:
+        cursor = ("p", before) if before is not None else ("n", after)
+        # scoring and fixture sync bump schedule version, so points and results are fresh
+        version = self.storage.schedule_version
+        cached = self.page_cache.get(user_id)
+        pages = cached[1] if cached is not None and cached[0] == version else {}
+        if cursor in pages:
+            return pages[cursor]
+
+        predictions, has_more = self.storage.get_user_predictions_page(
+            user_id, after, before, PREDICTIONS_PAGE_SIZE
+        )
+        total_points = self.storage.get_user_points(user_id)
+        # page is PREDICTIONS_PAGE_SIZE predictions long, so it fits into one message
+        # and can be edited in place
+        msg = MessageBuilder()
+        msg.add("*Ваши прогнозы на матчи UEFA EURO 2020*\n\n")
+        msg.add_lines(predictions, lambda prediction: render_prediction(
+            prediction, self.storage.get_match(prediction.match_id)
+        ))
+        msg.add(f"\n*ВСЕГО ОЧКОВ: {total_points}*\n\n")
+        msg.add("Для ввода прогноза на следующий матч, введите /predict\n")
+        msg.add("Для просмотра своих прогнозов, введите /me\n\n")
+        msg = msg.text()
+
+        has_prev = has_more if before is not None else after > 0
+        has_next = has_more if before is None else True
+        markup = self._predictions_page_markup(predictions, has_prev, has_next)
+
+        self.page_cache.set(user_id, (version, {**pages, cursor: (msg, markup)}))
+        return msg, markup
+
+    @staticmethod
+    def _predictions_page_markup(predictions: list, has_prev: bool,
+                                 has_next: bool) -> InlineKeyboardMarkup:
+        buttons = []
+        if predictions and has_prev:
+            cursor = f"{PREDICTIONS_CALLBACK_PREFIX}p:{predictions[0].match_id}"
+            buttons.append(InlineKeyboardButton("« Назад", callback_data=cursor))
+        if predictions and has_next:
+            cursor = f"{PREDICTIONS_CALLBACK_PREFIX}n:{predictions[-1].match_id}"
+            buttons.append(InlineKeyboardButton("Далее »", callback_data=cursor))
+        markup = InlineKeyboardMarkup()
+        if buttons:
+            markup.row(*buttons)
+        return markup
 
     def get_leaders(self, message):
         try:
@@ -286,13 +404,16 @@ class BotService:
                                 message.log)
             return
 
-        msg = "*Лидеры прогнозов на матчи UEFA EURO 2020*\n\n"
-        i = 1
-        for leader, points in leaders:
-            msg += f"{i}. {leader}: *{plural_points(points)}*\n"
-            i += 1
+        msg = MessageBuilder()
+        msg.add("*Лидеры прогнозов на матчи UEFA EURO 2020*\n\n")
+        msg.add_lines(enumerate(leaders, 1), self._render_leader)
 
-        self._send_buttons(message, msg)
+        self._send_buttons(message, msg.chunks())
+
+    @staticmethod
+    def _render_leader(item: tuple) -> str:
+        place, (leader, points) = item
+        return f"{place}. {render_user(leader)}: *{plural_points(points)}*"
 
     def notifications_enable(self, message):
         return self._set_user_notifications(message, True)
@@ -308,9 +429,8 @@ class BotService:
         """, message.log)
 
     def help_message(self, message):
-        local_tz = os.getenv("TZ", "Europe/Moscow")
         self._send_response(message.chat.id, """
-Время начала матчей указано в """ + local_tz + """
+Время начала матчей указано в """ + LOCAL_TZ_NAME + """
 
 Доступные команды:
 
@@ -345,67 +465,129 @@ class BotService:
     def unknown_message(self, message):
         if message.text.lower() == "мои прогнозы":
             return self.get_user_predictions(message)
-        self.storage.create_or_update_userlog(message.log)
 
-    def send_buttons_by_id(self, chat_id, reply_text: str):
+    def send_notification(self, chat_id: int, reply_text: str):
+        """
+        Sends message with buttons, errors are raised to let caller retry
+        """
         markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
         markup.add("Следующий матч", "Мои прогнозы")
+        self._send(chat_id, reply_text, markup)
 
-        try:
-            self.bot.send_message(chat_id, reply_text, reply_markup=markup)
-        except apihelper.ApiException as exc:
-            self.logger.error(f"failed to send buttons: {str(exc)}")
-            return None
-
-    def _send_buttons(self, message, reply_text: str):
+    def _send_buttons(self, message, reply_text: Union[str, Iterable[str]]):
         markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
         markup.add("Следующий матч", "Мои прогнозы")
 
-        try:
-            self.bot.reply_to(message, reply_text, reply_markup=markup)
-        except apihelper.ApiException as exc:
-            self.logger.error(f"failed to send buttons: {str(exc)}")
-            return None
+        return self._send_response(message.chat.id, reply_text, message.log, markup,
+                                   message.message_id)
 
-    def _send_buttons_split(self, message, reply_text: str):
-        markup = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        markup.add("Следующий матч", "Мои прогнозы")
+    def _render_matches(self, command: str, filter_: MatchFilter, title: str) -> tuple:
+        filter_date = filter_.datetime.date() if filter_.datetime else None
+        key = (command, filter_.group, filter_.stage, filter_.team_id, filter_date, date.today())
+        # version is read before query, so concurrent match update only makes entry stale
+        version = self.storage.schedule_version
+        cached = self.render_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        matches = self.storage.find_matches(filter_)
+        chunks = tuple(MessageBuilder().add(title).add_lines(matches, render_match).chunks())
+        self.render_cache.set(key, (version, chunks))
+        return chunks
 
+    # pylint: disable=too-many-arguments
+    def _send_response(self, chat_id: int, msg: Union[str, Iterable[str]], log: UserLog,
+                       reply_markup=None, reply_to_message_id: Optional[int] = None):
+        """
+        Sends response after transaction of handled update commits, errors are logged.
+        Returns sent message if it is sent right away, None otherwise.
+        """
+        if not isinstance(msg, str):
+            # chunks are rendered from ORM rows, which must not be loaded after commit
+            msg = tuple(msg)
+        return self._after_commit(self._try_send, chat_id, msg, log, reply_markup,
+                                  reply_to_message_id)
+
+    # pylint: disable=too-many-arguments
+    def _try_send(self, chat_id: int, msg: Union[str, Iterable[str]], log: UserLog,
+                  reply_markup=None, reply_to_message_id: Optional[int] = None):
         try:
-            if len(reply_text) > 4000:
-                start_idx = 0
-                while True:
-                    tmp_text = reply_text[start_idx:start_idx + 4000]
-                    reply_idx = tmp_text.rfind("\n")
-                    if reply_idx == 0:
-                        if tmp_text != "":
-                            self.bot.send_message(message.chat.id, tmp_text, reply_markup=markup)
-                        break
-
-                    reply = tmp_text[:reply_idx]
-                    if reply != "":
-                        self.bot.send_message(message.chat.id, reply, reply_markup=markup)
-                    start_idx += reply_idx
-            else:
-                self.bot.reply_to(message, reply_text, reply_markup=markup)
+            return self._send(chat_id, msg, reply_markup, reply_to_message_id, log)
         except apihelper.ApiException as exc:
-            self.logger.error(f"failed to send buttons: {str(exc)}")
+            self.logger.error(f"failed to send msg to {chat_id}: {str(exc)}")
             return None
 
-    def _send_response(self, chat_id: int, msg: str, log: UserLog):
+    def _ask(self, message, question: str, reply_markup, next_step):
+        """
+        Sends question and passes next message of the chat to next_step,
+        next step is not registered if question is not sent
+        """
+        sent = self._try_send(message.chat.id, question, message.log, reply_markup,
+                              message.message_id)
+        if sent is None:
+            return
+        self.bot.register_next_step_handler(sent, next_step)
+
+    def _after_commit(self, call, *args, **kwargs):
+        """
+        Defers Telegram call until transaction of handled update commits, so it isn't held
+        open during requests and users aren't told about changes which are rolled back.
+        Call is made right away outside of update handling.
+        """
+        outbox = getattr(self._outbox, "calls", None)
+        if outbox is None:
+            return call(*args, **kwargs)
+        outbox.append(functools.partial(call, *args, **kwargs))
+        return None
+
+    # pylint: disable=too-many-arguments
+    def _send(self, chat_id: int, msg: Union[str, Iterable[str]], reply_markup=None,
+              reply_to_message_id: Optional[int] = None, log: Optional[UserLog] = None):
+        """
+        Sends message split into chunks which fit Telegram limit. First chunk replies
+        to reply_to_message_id, markup is attached to the last one.
+        Returns last sent message.
+        :arg: msg - message text or chunks built by MessageBuilder
+        """
+        chunks = iter(split_message(msg) if isinstance(msg, str) else msg)
+        chunk = next(chunks, None)
+        if log is not None and chunk is not None:
+            log.response = chunk[0:255]
+        sent = None
+        while chunk is not None:
+            next_chunk = next(chunks, None)
+            sent = self._telegram("sendMessage", self.bot.send_message, chat_id, chunk,
+                                  reply_to_message_id=reply_to_message_id,
+                                  reply_markup=reply_markup if next_chunk is None else None)
+            reply_to_message_id = None
+            chunk = next_chunk
+        return sent
+
+    def _telegram(self, method: str, call, *args, **kwargs):
+        start = time.perf_counter()
         try:
-            message = self.bot.send_message(chat_id, msg)
-        except apihelper.ApiException as exc:
-            self.logger.error(f"failed to send msg {msg} to {chat_id}: {str(exc)}")
-            return None
-        log.response = msg[0:255]
-        self.storage.create_or_update_userlog(log)
-        return message
+            return call(*args, **kwargs)
+        except apihelper.ApiException:
+            self.telegram_errors.labels(method).inc()
+            raise
+        finally:
+            self.telegram_latency.labels(method).observe(time.perf_counter() - start)
 
     @staticmethod
-    def _build_handler_dict(handler, **filters):
+    def _timed(handler, latency: Family, label: Optional[str] = None):
+        histogram = latency.labels(label or handler.__name__)
+
+        @functools.wraps(handler)
+        def timed(*args, **kwargs):
+            with histogram.time():
+                return handler(*args, **kwargs)
+
+        return timed
+
+    def _build_handler_dict(self, handler, **filters):
         filters["content_types"] = ["text"]
+        label = filters["commands"][0] if "commands" in filters else handler.__name__
         return {
-            'function': handler,
+            'function': self._timed(handler, self.handler_latency, label),
             'filters': filters
         }
@@ -0,0 +1,64 @@
+"""
+In-process caches
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from metrics import Counter
+
+
+class TTLCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0):
+        """
+        :arg: max_size - max number of entries, least recently used are evicted
+        :arg: ttl - entry lifetime in seconds
+        """
+        self.max_size = max(max_size, 1)
+        self.ttl = ttl
+        self.hits = Counter()
+        self.misses = Counter()
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses.inc()
+                return None
+            self._data.move_to_end(key)
+        self.hits.inc()
+        return entry[1]
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """
+        Get value without touching LRU order and hit/miss counters
+        """
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits.value,
+            "misses": self.misses.value,
+        }
@@ -0,0 +1,163 @@
+"""
+Conversation state of users. Memory holds primary copy, DB is written behind in batches
+and is read on startup, so flows survive restarts.
+"""
+import threading
+from datetime import datetime, timedelta
+from logging import Logger
+from typing import NamedTuple, Optional
+
+from metrics import Counter
+from models import USER_STAGE_SIMPLE
+from .storage import StorageService
+
+
+class ChatState(NamedTuple):
+    stage: int
+    payload: Optional[str]
+    updated: datetime
+
+
+# pylint: disable=too-many-instance-attributes
+class ConversationStore:
+    def __init__(self,
+                 storage: StorageService,
+                 logger: Logger,
+                 ttl: float = 3600.0,
+                 flush_interval: float = 1.0):
+        """
+        :arg: storage - storage service
+        :arg: logger - logger object
+        :arg: ttl - seconds after which abandoned conversation is reset
+        :arg: flush_interval - max seconds state change stays unwritten
+        """
+        self.storage = storage
+        self.logger = logger
+        self.ttl = timedelta(seconds=ttl)
+        self.flush_interval = flush_interval
+        # user id -> state of users in the middle of conversation
+        self._states: dict[int, ChatState] = {}
+        # user id -> state to write, None resets conversation
+        self._dirty: dict[int, Optional[ChatState]] = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self.written = Counter()
+        self.expired = Counter()
+
+    def recover(self, shard: int = 0, shards: int = 1):
+        """
+        Loads conversations which are not expired yet and resets abandoned ones in DB
+        :arg: shard - index of process, only conversations of its chats are loaded
+        :arg: shards - number of processes, updates are sharded by chat id
+        """
+        since = datetime.utcnow() - self.ttl
+        try:
+            expired = self.storage.expire_chat_states(since)
+            rows = self.storage.get_chat_states(since)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error(f"failed to recover conversations: {str(exc)}")
+            return
+
+        with self._cond:
+            # id of private chat is Telegram id of user
+            rows = [row for row in rows if row.api_id % shards == shard]
+            for user_id, _, stage, payload, updated in rows:
+                self._states.setdefault(user_id, ChatState(stage, payload, updated))
+        self.logger.info(f"Recovered {len(rows)} conversations, {expired} expired")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="conversation-store",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        # run loop writes pending states before it exits
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        else:
+            self.flush()
+
+    def get(self, user_id: int) -> Optional[ChatState]:
+        with self._cond:
+            state = self._states.get(user_id)
+            if state is not None and state.updated < datetime.utcnow() - self.ttl:
+                self._reset(user_id)
+                self.expired.inc()
+                return None
+            return state
+
+    def set(self, user_id: int, stage: int, payload: Optional[str] = None):
+        state = ChatState(stage, payload, datetime.utcnow())
+        with self._cond:
+            self._states[user_id] = state
+            self._dirty[user_id] = state
+
+    def clear(self, user_id: int):
+        with self._cond:
+            if user_id in self._states:
+                self._reset(user_id)
+
+    def expire(self):
+        """
+        Resets conversations abandoned for longer than ttl
+        """
+        since = datetime.utcnow() - self.ttl
+        with self._cond:
+            expired = [user_id for user_id, state in self._states.items()
+                       if state.updated < since]
+            for user_id in expired:
+                self._reset(user_id)
+        self.expired.inc(len(expired))
+
+    def flush(self):
+        with self._cond:
+            batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+
+        now = datetime.utcnow()
+        states = [{
+            "user_id": user_id,
+            "stage": state.stage if state is not None else USER_STAGE_SIMPLE,
+            "payload": state.payload if state is not None else None,
+            "updated": state.updated if state is not None else now,
+        } for user_id, state in batch.items()]
+        try:
+            self.storage.save_chat_states(states)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error(f"failed to write {len(states)} conversation states: {str(exc)}")
+            with self._cond:
+                # newer changes made while writing win
+                for user_id, state in batch.items():
+                    self._dirty.setdefault(user_id, state)
+            return
+        self.written.inc(len(states))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "active": len(self._states),
+                "pending": len(self._dirty),
+                "written": self.written.value,
+                "expired": self.expired.value,
+            }
+
+    def _reset(self, user_id: int):
+        del self._states[user_id]
+        self._dirty[user_id] = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(self.flush_interval)
+                stopped = self._stopped
+            self.expire()
+            self.flush()
+            if stopped:
+                return
@@ -0,0 +1,211 @@
+"""
+elenasport.io data API client
+"""
+import http.client
+import json
+import queue
+import threading
+import time
+from logging import Logger
+from typing import Optional
+from urllib.parse import urlsplit
+
+from metrics import Counter, Histogram
+
+# refresh access token a bit earlier than it really expires
+TOKEN_EXPIRY_MARGIN = 60
+
+
+class DataApiError(Exception):
+    pass
+
+
+class _HostPool:
+    def __init__(self, url: str, size: int, timeout: float):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.latency = Histogram()
+        self._idle: queue.LifoQueue = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> http.client.HTTPConnection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        if self.scheme == "http":
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn: http.client.HTTPConnection):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# pylint: disable=too-many-instance-attributes
+class DataApiClient:
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 token: str,
+                 logger: Logger,
+                 api_url: str = "https://football.elenasport.io",
+                 auth_url: str = "https://oauth2.elenasport.io",
+                 timeout: float = 10.0,
+                 pool_size: int = 2):
+        """
+        :arg: token - elenasport.io API token
+        :arg: logger - logger object
+        :arg: api_url - data API base url
+        :arg: auth_url - OAuth2 server base url
+        :arg: timeout - connect and read timeout in seconds
+        :arg: pool_size - max idle keep-alive connections per host
+        """
+        self.api_token = token
+        self.logger = logger
+        self.requests = Counter()
+        self.errors = Counter()
+        self.token_refreshes = Counter()
+        self.not_modified = Counter()
+        self._api = _HostPool(api_url, pool_size, timeout)
+        self._auth = _HostPool(auth_url, pool_size, timeout)
+        self._access_token = ""
+        self._token_expires = 0.0
+        self._token_lock = threading.Lock()
+        # path -> validator headers of last successful response
+        self._validators: dict[str, dict] = {}
+
+    def get_json_if_modified(self, path: str) -> Optional[dict]:
+        """
+        Conditional GET with ETag/Last-Modified of previous response of the same path.
+        Returns None if server responds 304 Not Modified.
+        """
+        status, data = self._get(path, self._validators.get(path, {}))
+        if status == 304:
+            self.not_modified.inc()
+            return None
+
+        return self._parse(data)
+
+    def _get(self, path: str, extra_headers: dict) -> tuple[int, bytes]:
+        status, headers, data = self._authorized_get(path, extra_headers)
+        if status == 401:
+            # token may be revoked before its expiry
+            self._invalidate_token()
+            status, headers, data = self._authorized_get(path, extra_headers)
+        if status not in (200, 304):
+            self.errors.inc()
+            raise DataApiError(f"GET {path} failed with status {status}: {data[:200]!r}")
+
+        if status == 200:
+            validators = {}
+            if headers.get("ETag"):
+                validators["If-None-Match"] = headers["ETag"]
+            if headers.get("Last-Modified"):
+                validators["If-Modified-Since"] = headers["Last-Modified"]
+            self._validators[path] = validators
+
+        return status, data
+
+    def get_validators(self) -> dict[str, dict]:
+        return dict(self._validators)
+
+    def set_validators(self, validators: dict[str, dict]):
+        """
+        Restores validators, e.g. from snapshot, so first request after restart is conditional
+        """
+        self._validators = dict(validators)
+
+    def close(self):
+        self._api.close()
+        self._auth.close()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests.value,
+            "errors": self.errors.value,
+            "token_refreshes": self.token_refreshes.value,
+            "not_modified": self.not_modified.value,
+            "api_latency": self._api.latency.snapshot(),
+            "auth_latency": self._auth.latency.snapshot(),
+        }
+
+    def _authorized_get(self, path: str,
+                        extra_headers: dict) -> tuple[int, http.client.HTTPMessage, bytes]:
+        headers = {"Authorization": "Bearer " + self._get_token(), **extra_headers}
+        return self._request(self._api, "GET", path, None, headers)
+
+    def _get_token(self) -> str:
+        with self._token_lock:
+            if self._access_token and time.monotonic() < self._token_expires:
+                return self._access_token
+
+            headers = {
+                "Authorization": "Basic " + self.api_token,
+                "Content-Type": "application/x-www-form-urlencoded"
+            }
+            status, _, raw_data = self._request(self._auth, "POST", "/oauth2/token",
+                                                "grant_type=client_credentials", headers)
+            data = self._parse(raw_data)
+            if status != 200 or "error" in data:
+                self.errors.inc()
+                raise DataApiError(f"get access token error: {data.get('error', status)}")
+            if "access_token" not in data:
+                self.errors.inc()
+                raise DataApiError(f"missing access token field in response: {data}")
+
+            self.token_refreshes.inc()
+            self._access_token = data["access_token"]
+            expires_in = int(data.get("expires_in", 3600))
+            self._token_expires = time.monotonic() + max(expires_in - TOKEN_EXPIRY_MARGIN, 0)
+            return self._access_token
+
+    def _invalidate_token(self):
+        with self._token_lock:
+            self._access_token = ""
+
+    def _request(self, pool: _HostPool, method: str, path: str, body: Optional[str],
+                 headers: dict) -> tuple[int, http.client.HTTPMessage, bytes]:
+        # idle keep-alive connection may be closed by server, so retry once on a new one
+        for attempt in range(2):
+            conn = pool.acquire()
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as exc:
+                conn.close()
+                if attempt == 0 and isinstance(exc, (http.client.RemoteDisconnected,
+                                                     ConnectionResetError, BrokenPipeError)):
+                    continue
+                self.errors.inc()
+                raise DataApiError(f"{method} {pool.host}{path} failed: {str(exc)}") from exc
+            finally:
+                pool.latency.observe(time.perf_counter() - start)
+
+            self.requests.inc()
+            if response.will_close:
+                conn.close()
+            else:
+                pool.release(conn)
+            return response.status, response.headers, data
+
+        raise DataApiError(f"{method} {pool.host}{path} failed")
+
+    def _parse(self, raw_data: bytes) -> dict:
+        try:
+            return json.loads(raw_data)
+        except ValueError as exc:
+            self.errors.inc()
+            raise DataApiError(f"invalid JSON in response: {raw_data[:200]!r}") from exc
@@ -0,0 +1,106 @@
+"""
+Per-chat ordered update dispatcher
+"""
+import queue
+import threading
+import time
+from logging import Logger
+from typing import Callable, Optional
+
+from telebot.types import Update
+
+from metrics import Counter, Histogram
+
+
+# pylint: disable=too-few-public-methods
+class _Worker:
+    def __init__(self, idx: int, max_queue: int):
+        self.idx = idx
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.latency = Histogram()
+        self.errors = Counter()
+        self.thread: Optional[threading.Thread] = None
+
+
+class UpdateDispatcher:
+    def __init__(self,
+                 process_update: Callable[[Update], None],
+                 workers: int,
+                 logger: Logger,
+                 max_queue: int = 0):
+        """
+        :arg: process_update - callable which runs middlewares and handlers for update
+        :arg: workers - number of worker threads
+        :arg: logger - logger object
+        :arg: max_queue - max queued updates per worker, 0 means unbounded
+        """
+        self.process_update = process_update
+        self.logger = logger
+        self._workers = [_Worker(idx, max_queue) for idx in range(max(workers, 1))]
+
+    def start(self):
+        for worker in self._workers:
+            if worker.thread is not None:
+                continue
+            worker.thread = threading.Thread(target=self._run, args=(worker,),
+                                             name=f"dispatcher-{worker.idx}", daemon=True)
+            worker.thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        for worker in self._workers:
+            if worker.thread is not None:
+                worker.queue.put(None)
+        for worker in self._workers:
+            if worker.thread is not None:
+                worker.thread.join(timeout)
+                worker.thread = None
+
+    def dispatch(self, update: Update):
+        # Updates of one chat always go to the same worker, so next-step handlers
+        # (e.g. match select -> score enter -> predict) see messages in order
+        worker = self._workers[self.shard_key(update) % len(self._workers)]
+        worker.queue.put(update)
+
+    def stats(self) -> list[dict]:
+        return [{
+            "worker": worker.idx,
+            "queue_depth": worker.queue.qsize(),
+            "errors": worker.errors.value,
+            "latency": worker.latency.snapshot(),
+        } for worker in self._workers]
+
+    def _run(self, worker: _Worker):
+        while True:
+            update = worker.queue.get()
+            if update is None:
+                break
+
+            start = time.perf_counter()
+            try:
+                self.process_update(update)
+            except Exception as exc:  # pylint: disable=broad-except
+                worker.errors.inc()
+                self.logger.error(f"failed to process update {update.update_id}: {str(exc)}")
+            worker.latency.observe(time.perf_counter() - start)
+
+    @staticmethod
+    def shard_key(update: Update) -> int:
+        for message in (update.message, update.edited_message, update.channel_post,
+                        update.edited_channel_post):
+            if message is not None:
+                return message.chat.id
+
+        if update.callback_query is not None:
+            if update.callback_query.message is not None:
+                return update.callback_query.message.chat.id
+            return update.callback_query.from_user.id
+
+        for query in (update.inline_query, update.chosen_inline_result,
+                      update.shipping_query, update.pre_checkout_query):
+            if query is not None:
+                return query.from_user.id
+
+        if update.poll_answer is not None:
+            return update.poll_answer.user.id
+
+        return update.update_id
@@ -0,0 +1,97 @@
+"""
+Leader election of bot processes with Postgres advisory lock
+"""
+import threading
+from logging import Logger
+from typing import Callable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class LeaderElection:
+    def __init__(self,
+                 connect: Callable[[], Connection],
+                 lock_id: int,
+                 logger: Logger,
+                 on_change: Optional[Callable[[bool], None]] = None):
+        """
+        :arg: connect - opens DB connection, it is kept open while process is leader
+        :arg: lock_id - advisory lock key, same for all processes of bot
+        :arg: logger - logger object
+        :arg: on_change - called with new state when leadership is gained or lost
+        """
+        self.connect = connect
+        self.lock_id = lock_id
+        self.logger = logger
+        self.on_change = on_change
+        self.leader = False
+        self._conn: Optional[Connection] = None
+        self._lock = threading.Lock()
+
+    def is_leader(self) -> bool:
+        """
+        Checks that lock is still held or tries to take it. Session level lock is
+        released by Postgres when connection is closed, e.g. when leader process dies.
+        """
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.execute(text("SELECT 1"))
+                    return True
+                except SQLAlchemyError as exc:
+                    self.logger.error(f"leader lock connection is lost: {str(exc)}")
+                    self._close()
+
+            try:
+                # no transaction is left open while lock is held
+                conn = self.connect().execution_options(isolation_level="AUTOCOMMIT")
+            except SQLAlchemyError as exc:
+                self.logger.error(f"failed to connect for leader lock: {str(exc)}")
+                return False
+            try:
+                acquired = conn.execute(text("SELECT pg_try_advisory_lock(:lock_id)"),
+                                        {"lock_id": self.lock_id}).scalar()
+            except SQLAlchemyError as exc:
+                self.logger.error(f"failed to take leader lock: {str(exc)}")
+                acquired = False
+            if not acquired:
+                conn.close()
+                return False
+
+            self._conn = conn
+            self._set_leader(True)
+            return True
+
+    def guard(self, job: Callable[[], None]) -> Callable[[], None]:
+        """
+        Wraps job, so it runs only in leader process
+        """
+        def run():
+            if self.is_leader():
+                job()
+            else:
+                self.logger.debug("not a leader, skip")
+
+        return run
+
+    def release(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.close()
+        except SQLAlchemyError:
+            pass
+        self._conn = None
+        self._set_leader(False)
+
+    def _set_leader(self, leader: bool):
+        self.leader = leader
+        self.logger.info("Process is leader now" if leader else "Process is not leader anymore")
+        if self.on_change is not None:
+            self.on_change(leader)
@@ -0,0 +1,76 @@
+"""
+Write-behind sink for user logs
+"""
+import threading
+from logging import Logger
+from typing import Optional
+
+from models import UserLog
+from .storage import StorageService
+
+
+# pylint: disable=too-many-instance-attributes
+class UserLogSink:
+    def __init__(self,
+                 storage: StorageService,
+                 logger: Logger,
+                 batch_size: int = 100,
+                 flush_interval: float = 5.0):
+        """
+        :arg: storage - storage service
+        :arg: logger - logger object
+        :arg: batch_size - flush as soon as that many logs are buffered
+        :arg: flush_interval - max seconds log stays in buffer
+        """
+        self.storage = storage
+        self.logger = logger
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self._buffer: list[UserLog] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="userlog-sink", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def put(self, log: UserLog):
+        """
+        Log must be put once, when update is handled and response is known,
+        so request and response are written as a single row
+        """
+        with self._cond:
+            self._buffer.append(log)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def flush(self):
+        with self._cond:
+            batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+
+        try:
+            self.storage.create_userlogs(batch)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error(f"failed to write {len(batch)} user logs: {str(exc)}")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                stopped = self._stopped
+            self.flush()
+            if stopped:
+                return
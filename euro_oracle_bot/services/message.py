@@ -0,0 +1,196 @@
+"""
+Outgoing message building. Parts are collected as they are rendered and split into
+chunks which fit Telegram message limit in one pass, without breaking Markdown entities.
+"""
+import re
+from typing import Callable, Iterable, Iterator, Optional
+
+# Telegram limit of message text, in UTF-16 code units
+MAX_MESSAGE_LENGTH = 4096
+
+# escaped character or entity marker of legacy Markdown
+_MARKUP = re.compile(r"\\.|[*_`]", re.DOTALL)
+
+
+def utf16_len(text: str) -> int:
+    # characters outside of BMP take two code units
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _entity_after(text: str, marker: Optional[str]) -> Optional[str]:
+    """
+    Returns marker of entity left open at the end of text
+    :arg: marker - marker of entity open at the start of text
+    """
+    for token in _MARKUP.finditer(text):
+        char = token.group()
+        if len(char) == 2:
+            # backslash escapes only outside of entities
+            if marker is None or char[1] != marker:
+                continue
+            char = char[1]
+        if marker is None:
+            marker = char
+        elif marker == char:
+            marker = None
+    return marker
+
+
+def _positions(text: str) -> tuple[list, list, list]:
+    """
+    Returns marker of entity open before every position of text, whether character
+    at position is escaped and UTF-16 offset of position
+    """
+    markers: list[Optional[str]] = []
+    escapes: list[bool] = []
+    offsets = [0]
+    marker = None
+    escaped = False
+    for char in text:
+        markers.append(marker)
+        escapes.append(escaped)
+        offsets.append(offsets[-1] + (2 if ord(char) > 0xFFFF else 1))
+        if escaped:
+            escaped = False
+            if char == marker:
+                marker = None
+        elif char == "\\":
+            escaped = True
+        elif char in "*_`":
+            if marker is None:
+                marker = char
+            elif marker == char:
+                marker = None
+    markers.append(marker)
+    escapes.append(False)
+    return markers, escapes, offsets
+
+
+def _split_long(text: str, limit: int) -> Iterator[str]:
+    """
+    Splits text longer than limit at last whitespace outside of entities or, if there is
+    none, inside of entity. Entity which is split apart is closed at the end of piece and
+    reopened at the start of the next one, so Telegram can parse both.
+    Text is cut at limit only if there is no whitespace.
+    """
+    markers, escapes, offsets = _positions(text)
+    start = 0
+    reopen = ""
+    while len(reopen) + offsets[-1] - offsets[start] > limit:
+        # size of piece which ends at position is base + offset, plus closing marker
+        base = len(reopen) - offsets[start]
+        end = start + 1
+        while end < len(text) and \
+                base + offsets[end + 1] + (markers[end + 1] is not None) <= limit:
+            end += 1
+
+        cut = next((index for index in range(end, start, -1)
+                    if text[index - 1].isspace() and markers[index] is None), None)
+        if cut is None:
+            # whitespace inside entity is dropped, so entity doesn't end or start with it
+            cut = next((index for index in range(end, start, -1)
+                        if index < len(text) and text[index].isspace()
+                        and markers[index] is not None
+                        and base + offsets[index] + 1 <= limit), None)
+            resume = cut + 1 if cut is not None else None
+        else:
+            resume = cut
+        if cut is None:
+            cut = end
+            if escapes[cut] and cut - 1 > start:
+                # backslash is not separated from escaped character
+                cut -= 1
+            if markers[cut] is not None and text[cut] == markers[cut] and cut - 1 > start:
+                # closing marker is not left alone in the next piece
+                cut -= 1
+            if markers[cut] is not None and markers[cut - 1] is None and cut - 1 > start:
+                # entity would be empty, it is moved to the next piece
+                cut -= 1
+            resume = cut
+
+        closed = markers[cut]
+        yield reopen + text[start:cut] + (closed or "")
+        reopen = closed or ""
+        start = resume
+
+    if start < len(text):
+        yield reopen + text[start:]
+
+
+class MessageBuilder:
+    def __init__(self, limit: int = MAX_MESSAGE_LENGTH):
+        """
+        :arg: limit - max chunk length in UTF-16 code units
+        """
+        self.limit = limit
+        self._parts: list[Iterable[str]] = []
+
+    def add(self, text: str) -> "MessageBuilder":
+        self._parts.append((text,))
+        return self
+
+    def add_lines(self, items: Iterable, render: Callable[..., str]) -> "MessageBuilder":
+        """
+        Adds rendered line for every item, items are rendered when chunks are built
+        """
+        self._parts.append(f"{render(item)}\n" for item in items)
+        return self
+
+    def text(self) -> str:
+        return "".join(part for parts in self._parts for part in parts)
+
+    def chunks(self) -> Iterator[str]:
+        """
+        Yields message chunks, split at line ends outside of Markdown entities.
+        Lines are split only if they do not fit into one chunk.
+        Builder is consumed, it yields chunks once.
+        """
+        chunk: list[str] = []
+        size = 0
+        # lines of entity which spans several lines, they are never split apart
+        block: list[str] = []
+        marker = None
+        for parts in self._parts:
+            for part in parts:
+                for line in part.splitlines(keepends=True):
+                    block.append(line)
+                    marker = _entity_after(line, marker)
+                    if marker is not None:
+                        continue
+
+                    text = "".join(block) if len(block) > 1 else line
+                    block.clear()
+                    length = utf16_len(text)
+                    if chunk and size + length > self.limit:
+                        yield from self._non_blank("".join(chunk))
+                        chunk.clear()
+                        size = 0
+                    if length > self.limit:
+                        *full, text = _split_long(text, self.limit)
+                        for piece in full:
+                            yield from self._non_blank(piece)
+                        length = utf16_len(text)
+                    chunk.append(text)
+                    size += length
+        self._parts = []
+
+        if block:
+            # unclosed entity is sent as is, Telegram reports it
+            chunk.append("".join(block))
+            size += utf16_len(chunk[-1])
+        text = "".join(chunk)
+        if size > self.limit:
+            for piece in _split_long(text, self.limit):
+                yield from self._non_blank(piece)
+        else:
+            yield from self._non_blank(text)
+
+    @staticmethod
+    def _non_blank(text: str) -> Iterator[str]:
+        # Telegram rejects empty messages
+        if text.strip():
+            yield text
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    return list(MessageBuilder(limit).add(text).chunks())
@@ -0,0 +1,193 @@
+"""
+Rate limited notification dispatcher
+"""
+import heapq
+import itertools
+import threading
+import time
+from logging import Logger
+from typing import Callable
+
+from requests.exceptions import RequestException
+from telebot.apihelper import ApiException, ApiTelegramException, ApiHTTPException, \
+    ApiInvalidJSONException
+
+from metrics import Counter
+
+# see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 25.0
+CHAT_INTERVAL = 1.0
+
+
+# pylint: disable=too-few-public-methods
+class _Job:
+    def __init__(self, chat_id: int, text: str):
+        self.chat_id = chat_id
+        self.text = text
+        self.attempt = 0
+
+
+# pylint: disable=too-many-instance-attributes
+class NotificationDispatcher:
+    def __init__(self,
+                 send: Callable[[int, str], None],
+                 logger: Logger,
+                 workers: int = 8,
+                 max_retries: int = 3):
+        """
+        :arg: send - callable which sends text to chat, Telegram errors must be raised
+        :arg: logger - logger object
+        :arg: workers - number of sending threads
+        :arg: max_retries - max retries of failed message
+        """
+        self.send = send
+        self.logger = logger
+        self.workers = max(workers, 1)
+        self.max_retries = max_retries
+        self.sent = Counter()
+        self.failed = Counter()
+        self.retried = Counter()
+
+        # (ready_at, seq, job) heap, jobs are taken when ready_at comes
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads: list[threading.Thread] = []
+
+        self._global_next = 0.0
+        self._chat_next: dict[int, float] = {}
+        self._in_flight = 0
+
+    def start(self):
+        self._stopped = False
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"notifier-{idx}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 30.0):
+        """
+        Waits until queued messages are sent, but not longer than timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._queue or self._in_flight) and time.monotonic() < deadline:
+                self._cond.wait(0.5)
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def notify(self, chat_id: int, text: str):
+        self._push(_Job(chat_id, text), time.monotonic())
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "sent": self.sent.value,
+            "failed": self.failed.value,
+            "retried": self.retried.value,
+        }
+
+    def _push(self, job: _Job, ready_at: float):
+        with self._cond:
+            heapq.heappush(self._queue, (ready_at, next(self._seq), job))
+            self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                if not self._queue:
+                    # drop rate limits of chats which passed, so map doesn't grow forever
+                    self._chat_next = {chat_id: chat_ready
+                                       for chat_id, chat_ready in self._chat_next.items()
+                                       if chat_ready > now}
+                    self._cond.wait()
+                    continue
+                ready_at, _, job = self._queue[0]
+                chat_ready = self._chat_next.get(job.chat_id, 0)
+                if chat_ready > max(ready_at, now):
+                    # postpone job of busy chat, so it doesn't block other chats
+                    heapq.heapreplace(self._queue, (chat_ready, next(self._seq), job))
+                    continue
+                ready_at = max(ready_at, self._global_next)
+                if ready_at > now:
+                    self._cond.wait(ready_at - now)
+                    continue
+
+                heapq.heappop(self._queue)
+                # reserve slots, so other workers don't exceed limits while this one sends
+                self._global_next = max(self._global_next, now) + 1 / GLOBAL_RATE
+                self._chat_next[job.chat_id] = now + CHAT_INTERVAL
+                self._in_flight += 1
+                return job
+        return None
+
+    def _run(self):
+        while True:
+            job = self._take()
+            if job is None:
+                return
+            try:
+                self._send(job)
+            except Exception as exc:  # pylint: disable=broad-except
+                # worker must survive any error, otherwise queued jobs are never sent
+                self.failed.inc()
+                self.logger.error(f"failed to notify {job.chat_id}: {str(exc)}")
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    if self._chat_next.get(job.chat_id, 0) < time.monotonic():
+                        self._chat_next.pop(job.chat_id, None)
+                    self._cond.notify_all()
+
+    def _send(self, job: _Job):
+        try:
+            self.send(job.chat_id, job.text)
+        except ApiTelegramException as exc:
+            if exc.error_code == 429:
+                retry_after = exc.result_json.get("parameters", {}).get("retry_after", 1)
+                # flood limit is applied to the whole bot, so pause all workers
+                with self._cond:
+                    self._global_next = max(self._global_next, time.monotonic() + retry_after)
+                self._retry(job, retry_after, str(exc))
+            elif exc.error_code >= 500:
+                self._retry(job, 2 ** job.attempt, str(exc))
+            else:
+                self.failed.inc()
+                self.logger.error(f"failed to notify {job.chat_id}: {str(exc)}")
+            return
+        except ApiInvalidJSONException as exc:
+            # e.g. HTML error page of proxy in front of Bot API
+            self._retry(job, 2 ** job.attempt, str(exc))
+            return
+        except ApiHTTPException as exc:
+            if getattr(exc.result, "status_code", 0) >= 500:
+                self._retry(job, 2 ** job.attempt, str(exc))
+            else:
+                self.failed.inc()
+                self.logger.error(f"failed to notify {job.chat_id}: {str(exc)}")
+            return
+        except ApiException as exc:
+            self.failed.inc()
+            self.logger.error(f"failed to notify {job.chat_id}: {str(exc)}")
+            return
+        except RequestException as exc:
+            self._retry(job, 2 ** job.attempt, str(exc))
+            return
+
+        self.sent.inc()
+
+    def _retry(self, job: _Job, delay: float, error: str):
+        if job.attempt >= self.max_retries:
+            self.failed.inc()
+            self.logger.error(f"failed to notify {job.chat_id} after retries: {error}")
+            return
+
+        job.attempt += 1
+        self.retried.inc()
+        self.logger.warning(f"retry notification to {job.chat_id} in {delay}s: {error}")
+        self._push(job, time.monotonic() + delay)
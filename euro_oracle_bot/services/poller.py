@@ -0,0 +1,74 @@
+"""
+Long polling update ingestion
+"""
+import threading
+from logging import Logger
+from typing import Callable, Optional
+
+import telebot
+from telebot.types import Update
+
+
+class UpdatePoller:
+    def __init__(self, bot: telebot.TeleBot, dispatch: Callable[[Update], None], logger: Logger):
+        """
+        :arg: bot - bot used to get updates
+        :arg: dispatch - callable which queues update for processing
+        :arg: logger - logger object
+        """
+        self.bot = bot
+        self.dispatch = dispatch
+        self.logger = logger
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # offset after last dispatched update, it is changed with stop flag checked under lock
+        self._lock = threading.Lock()
+        self._offset: Optional[int] = None
+
+    def start(self):
+        self.bot.remove_webhook()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="polling", daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def stop(self):
+        """
+        Stops dispatching and confirms dispatched updates, so they aren't received again.
+        Must be called before dispatcher is stopped: updates received after that are not
+        confirmed and are received again on next start.
+        """
+        with self._lock:
+            self._stopped.set()
+            offset = self._offset
+        if offset is None:
+            return
+        try:
+            # request with offset confirms all updates before it, long poll in progress
+            # is terminated by it
+            self.bot.get_updates(offset=offset, limit=1, timeout=0)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error(f"failed to confirm updates: {str(exc)}")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                updates = self.bot.get_updates(offset=self._offset, timeout=20,
+                                               long_polling_timeout=20)
+            except Exception as exc:  # pylint: disable=broad-except
+                if self._stopped.is_set():
+                    # long poll is terminated by stop
+                    return
+                self.logger.error(f"failed to get updates: {str(exc)}")
+                self._stopped.wait(3)
+                continue
+
+            with self._lock:
+                if self._stopped.is_set():
+                    return
+                for update in updates:
+                    self._offset = max(self._offset or 0, update.update_id + 1)
+                    self.dispatch(update)
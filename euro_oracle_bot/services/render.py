@@ -0,0 +1,97 @@
+"""
+Message rendering of matches, predictions and users.
+Output is the same as __str__ of models, but timezone, stage labels and escaped names
+are resolved once instead of on every call.
+"""
+import os
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Iterable
+
+import pytz
+
+from models import User, Match, Prediction
+from models import STAGE_18, STAGE_14, STAGE_12, STAGE_FINAL
+from models import MATCH_STATUS_NOT_STARTED, MATCH_STATUS_IN_PROGRESS, MATCH_STATUS_FINISHED
+from .utils import plural_points
+
+LOCAL_TZ_NAME = os.getenv("TZ", "Europe/Moscow")
+LOCAL_TZ = pytz.timezone(LOCAL_TZ_NAME)
+
+STAGE_LABELS = {
+    STAGE_18: "_1/8 финала_",
+    STAGE_14: "_1/4 финала_",
+    STAGE_12: "_1/2 финала_",
+    STAGE_FINAL: "_Финал_",
+}
+
+
+@lru_cache(maxsize=8192)
+def escape_markdown(text: str) -> str:
+    return text.replace("_", "\\_").replace("*", "\\*").replace("[", "\\[")
+
+
+@lru_cache(maxsize=1024)
+def format_kickoff(match_dt: datetime) -> str:
+    return match_dt.replace(tzinfo=pytz.utc).astimezone(LOCAL_TZ).strftime('%d.%m.%Y %H:%M')
+
+
+@lru_cache(maxsize=64)
+def stage_label(stage: int, group: str) -> str:
+    if stage < STAGE_18:
+        return f"_Группа {group}_"
+    return STAGE_LABELS.get(stage, "")
+
+
+def render_user(user: User) -> str:
+    if user.full_name is not None:
+        if user.username is not None:
+            return f"{escape_markdown(user.full_name)} ({escape_markdown(user.username)})"
+        return escape_markdown(user.full_name)
+    if user.username is not None:
+        return escape_markdown(user.username)
+
+    return f"ID{user.id}"
+
+
+def render_score(match: Match) -> str:
+    parts = [f"*{match.team_home.title} {match.home_goals_total} -"
+             f" {match.away_goals_total} {match.team_away.title}*"]
+
+    if match.home_goals_pen is not None and match.away_goals_pen is not None and \
+            match.home_goals_pen + match.away_goals_pen != 0:
+        parts.append(f", пен. {match.home_goals_pen} - {match.away_goals_pen} "
+                     f"(осн. время: {match.home_goals_90} - {match.away_goals_90})")
+    elif match.away_goals_total != match.away_goals_90 or \
+            match.home_goals_total != match.home_goals_90:
+        parts.append(f" (осн. время: {match.home_goals_90} - {match.away_goals_90})")
+
+    return "".join(parts)
+
+
+def render_match(match: Match) -> str:
+    parts = [f"*ID {match.id}*. {format_kickoff(match.datetime)} ",
+             stage_label(match.stage, match.group)]
+
+    if match.status == MATCH_STATUS_NOT_STARTED:
+        parts.append(f" : {match.team_home.title} - {match.team_away.title} *(не начался)*")
+    elif match.status == MATCH_STATUS_FINISHED:
+        parts.append(f" : *{match.id}*: {render_score(match)}")
+    elif match.status == MATCH_STATUS_IN_PROGRESS:
+        parts.append(f" : *{match.id}*: {render_score(match)} *(матч идёт)*")
+
+    return "".join(parts)
+
+
+def render_prediction(prediction: Prediction, match: Match = None) -> str:
+    match = match or prediction.match
+    parts = [render_match(match), "\n",
+             f"*Ваш прогноз: {prediction.home_goals} - {prediction.away_goals}*"]
+    if match.status == MATCH_STATUS_FINISHED:
+        parts.append(f" (*{plural_points(prediction.points)}*)")
+
+    return "".join(parts)
+
+
+def render_lines(items: Iterable, render: Callable) -> str:
+    return "".join([f"{render(item)}\n" for item in items])
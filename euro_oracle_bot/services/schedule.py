@@ -0,0 +1,129 @@
+"""
+In-memory schedule: all matches and teams of tournament
+"""
+import bisect
+import threading
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from models import Match, Team, MatchFilter
+from db import Db
+
+
+# pylint: disable=too-many-instance-attributes
+class ScheduleSnapshot:
+    """
+    Immutable indexed set of matches and teams. Objects are shared by all threads,
+    so they must never be modified or added to a session.
+    """
+
+    def __init__(self, matches: list[Match], teams: list[Team], version: int):
+        self.version = version
+        # changes when matches or teams are written, see ScheduleStore.refresh_if_changed
+        self.marker = (len(matches), max((match.updated for match in matches
+                                          if match.updated is not None), default=None),
+                       len(teams))
+        self.matches = tuple(sorted(matches, key=lambda match: (match.datetime, match.id)))
+        self.teams = tuple(teams)
+        self._datetimes = [match.datetime for match in self.matches]
+
+        self._by_id = {match.id: match for match in self.matches}
+        self._by_group: dict[str, tuple] = self._index(lambda match: (match.group,))
+        self._by_stage: dict[int, tuple] = self._index(lambda match: (match.stage,))
+        self._by_date: dict[date, tuple] = self._index(lambda match: (match.datetime.date(),))
+        self._by_team: dict[int, tuple] = self._index(
+            lambda match: {match.team_home_id, match.team_away_id}
+        )
+
+    def get_match(self, id_) -> Optional[Match]:
+        try:
+            return self._by_id.get(int(id_))
+        except (TypeError, ValueError):
+            return None
+
+    def find_matches(self, filter_: MatchFilter) -> list[Match]:
+        candidates = [self.matches]
+        if filter_.group:
+            candidates.append(self._by_group.get(filter_.group, ()))
+        if filter_.stage:
+            candidates.append(self._by_stage.get(filter_.stage, ()))
+        if filter_.team_id:
+            candidates.append(self._by_team.get(filter_.team_id, ()))
+        if filter_.datetime:
+            day = filter_.datetime.date()
+            # matches at midnight of the next day are included, as it always was
+            next_midnight = datetime(day.year, day.month, day.day) + timedelta(1)
+            candidates.append(self._by_date.get(day, ()) + tuple(
+                match for match in self._by_date.get(next_midnight.date(), ())
+                if match.datetime == next_midnight
+            ))
+
+        # scan the smallest index, every index is sorted by kickoff
+        smallest = min(candidates, key=len)
+        others = [{match.id for match in matches} for matches in candidates
+                  if matches is not smallest]
+        return [match for match in smallest if all(match.id in ids for ids in others)]
+
+    def upcoming(self, now: datetime) -> tuple:
+        """
+        Matches with kickoff after now, sorted by kickoff
+        """
+        return self.matches[bisect.bisect_right(self._datetimes, now):]
+
+    def _index(self, keys) -> dict:
+        index: dict = {}
+        for match in self.matches:
+            for key in keys(match):
+                index.setdefault(key, []).append(match)
+        return {key: tuple(matches) for key, matches in index.items()}
+
+
+class ScheduleStore:
+    def __init__(self, db_service: Db):
+        """
+        :arg: db_service - db service
+        """
+        self.db_service = db_service
+        self._snapshot: Optional[ScheduleSnapshot] = None
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> ScheduleSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.refresh()
+        return snapshot
+
+    def refresh(self) -> ScheduleSnapshot:
+        """
+        Reloads schedule from DB and atomically replaces current snapshot
+        """
+        with self._lock:
+            # objects are shared, so they must not be expired by rollback of unit of work
+            with self.db_service.session_scope(shared=False) as sess:
+                matches = sess.query(Match).options(
+                    joinedload(Match.team_home), joinedload(Match.team_away)
+                ).all()
+                teams = sess.query(Team).all()
+
+            version = self._snapshot.version + 1 if self._snapshot is not None else 1
+            self._snapshot = ScheduleSnapshot(matches, teams, version)
+
+        return self._snapshot
+
+    def refresh_if_changed(self) -> bool:
+        """
+        Reloads schedule if it was written since last load, e.g. by another process.
+        Every match write sets match.updated. Returns True if schedule was reloaded.
+        """
+        with self.db_service.session_scope(shared=False) as sess:
+            count, updated = sess.query(func.count(Match.id), func.max(Match.updated)).one()
+            teams = sess.query(func.count(Team.id)).scalar()
+
+        if self._snapshot is not None and self._snapshot.marker == (count, updated, teams):
+            return False
+        self.refresh()
+        return True
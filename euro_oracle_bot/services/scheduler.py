@@ -0,0 +1,75 @@
+"""
+Sync job scheduler
+"""
+import random
+import threading
+from logging import Logger
+from typing import Callable, Optional
+
+
+# pylint: disable=too-many-instance-attributes
+class SyncScheduler:
+    def __init__(self,
+                 job: Callable[[], None],
+                 next_delay: Callable[[], float],
+                 logger: Logger,
+                 jitter: float = 0.1):
+        """
+        :arg: job - sync job
+        :arg: next_delay - returns seconds until next run, called after every run
+        :arg: logger - logger object
+        :arg: jitter - max relative random deviation of delay
+        """
+        self.job = job
+        self.next_delay = next_delay
+        self.logger = logger
+        self.jitter = jitter
+        self._running = threading.Lock()
+        self._timer_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._stopped = False
+
+    def start(self, delay: float = 0):
+        self._stopped = False
+        self._schedule(delay)
+
+    def stop(self):
+        with self._timer_lock:
+            self._stopped = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def run_now(self) -> bool:
+        """
+        Runs job unless it is already running. Returns False if run was skipped.
+        """
+        if not self._running.acquire(blocking=False):  # pylint: disable=consider-using-with
+            self.logger.debug("sync is already running, skip")
+            return False
+        try:
+            self.job()
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error(f"sync failed: {str(exc)}")
+        finally:
+            self._running.release()
+        return True
+
+    def _run(self):
+        self.run_now()
+        try:
+            delay = self.next_delay()
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error(f"failed to get next sync time: {str(exc)}")
+            delay = 60
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        self.logger.debug(f"next sync in {delay:.0f}s")
+        self._schedule(delay)
+
+    def _schedule(self, delay: float):
+        with self._timer_lock:
+            if self._stopped:
+                return
+            self._timer = threading.Timer(delay, self._run)
+            self._timer.daemon = True
+            self._timer.start()
@@ -0,0 +1,53 @@
+"""
+Prediction scoring rules
+"""
+from sqlalchemy import and_, case, func
+from sqlalchemy.sql import ColumnElement
+
+from models import Prediction, get_match_result
+
+BIG_WIN_DIFF = 3
+
+POINTS_BIG_WIN_SCORE = 5
+POINTS_BIG_WIN_DIFF = 4
+POINTS_SCORE = 3
+POINTS_DIFF = 2
+POINTS_RESULT = 1
+
+
+def score_prediction(home_goals: int, away_goals: int, pred_home: int, pred_away: int) -> int:
+    """
+    Reference implementation of scoring rules, must give the same result as points_expression
+    """
+    diff = abs(home_goals - away_goals)
+    big_win = diff >= BIG_WIN_DIFF
+    if home_goals == pred_home and away_goals == pred_away:
+        return POINTS_BIG_WIN_SCORE if big_win else POINTS_SCORE
+    if get_match_result(home_goals, away_goals) == get_match_result(pred_home, pred_away):
+        if diff == abs(pred_home - pred_away):
+            return POINTS_BIG_WIN_DIFF if big_win else POINTS_DIFF
+        return POINTS_RESULT
+
+    return 0
+
+
+def points_expression(home_goals: int, away_goals: int) -> ColumnElement:
+    """
+    SQL expression which scores all predictions of match with given result at once
+    """
+    diff = abs(home_goals - away_goals)
+    big_win = diff >= BIG_WIN_DIFF
+    # sign of goal difference gives the same outcome as get_match_result
+    result = (home_goals > away_goals) - (home_goals < away_goals)
+
+    exact_score = and_(Prediction.home_goals == home_goals,
+                       Prediction.away_goals == away_goals)
+    same_result = func.sign(Prediction.home_goals - Prediction.away_goals) == result
+    same_diff = func.abs(Prediction.home_goals - Prediction.away_goals) == diff
+
+    return case(
+        (exact_score, POINTS_BIG_WIN_SCORE if big_win else POINTS_SCORE),
+        (and_(same_result, same_diff), POINTS_BIG_WIN_DIFF if big_win else POINTS_DIFF),
+        (same_result, POINTS_RESULT),
+        else_=0
+    )
@@ -0,0 +1,63 @@
+"""
+On-disk snapshot of last good fixtures response
+"""
+import gzip
+import json
+import os
+import time
+from logging import Logger
+from typing import Optional
+
+SNAPSHOT_VERSION = 1
+
+
+class FixtureSnapshot:
+    def __init__(self, path: str, logger: Logger):
+        """
+        :arg: path - snapshot file path, gzipped JSON
+        :arg: logger - logger object
+        """
+        self.path = path
+        self.logger = logger
+        # unix time of last saved or loaded snapshot, 0 if there is none
+        self.saved_at = 0.0
+
+    def load(self) -> Optional[dict]:
+        """
+        Returns snapshot with "fixtures" and "validators" keys or None
+        if file is missing or broken
+        """
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            self.logger.error(f"failed to load fixtures snapshot {self.path}: {str(exc)}")
+            return None
+
+        if data.get("version") != SNAPSHOT_VERSION:
+            self.logger.warning(f"fixtures snapshot {self.path} has unknown version, ignore")
+            return None
+
+        self.saved_at = data["saved_at"]
+        return data
+
+    def save(self, fixtures: list[dict], validators: dict[str, dict]):
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "saved_at": time.time(),
+            "fixtures": fixtures,
+            "validators": validators,
+        }
+        # write to temporary file first, so crash never leaves truncated snapshot
+        tmp_path = self.path + ".tmp"
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+                json.dump(data, file, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            self.logger.error(f"failed to save fixtures snapshot {self.path}: {str(exc)}")
+            return
+
+        self.saved_at = data["saved_at"]
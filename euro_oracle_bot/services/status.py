@@ -0,0 +1,72 @@
+"""
+HTTP server of health and readiness probes
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Callable, Optional
+
+
+class StatusServer:
+    def __init__(self, host: str, port: int, logger: Logger):
+        """
+        :arg: host - listen address
+        :arg: port - listen port
+        :arg: logger - logger object
+        """
+        self.host = host
+        self.port = port
+        self.logger = logger
+        # path -> callable returning (status, content type, body)
+        self.routes: dict[str, Callable[[], tuple[int, str, bytes]]] = {}
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def add_route(self, path: str, handler: Callable[[], tuple[int, str, bytes]]):
+        self.routes[path] = handler
+
+    def add_probe(self, path: str, probe: Callable[[], tuple[bool, dict]]):
+        """
+        Adds route which answers 200 if probe passes and 503 otherwise,
+        with details returned by probe as JSON body
+        """
+        def handler():
+            passed, details = probe()
+            return 200 if passed else 503, "application/json", json.dumps(details).encode()
+
+        self.add_route(path, handler)
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                route = server.routes.get(self.path.split("?", 1)[0])
+                if route is None:
+                    status, content_type, body = 404, "text/plain", b"not found"
+                else:
+                    try:
+                        status, content_type, body = route()
+                    except Exception as exc:  # pylint: disable=broad-except
+                        server.logger.error(f"status route {self.path} failed: {str(exc)}")
+                        status, content_type, body = 500, "text/plain", b"error"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                server.logger.debug(f"status request: {format % args}")
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="status-server",
+                         daemon=True).start()
+        self.logger.info(f"Status server listening on {self.host}:{self.port}")
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -1,189 +1,394 @@
+import functools
 from logging import Logger
-from datetime import datetime, timedelta
+from datetime import datetime
+from types import FunctionType
 
-from sqlalchemy.orm import joinedload
-from sqlalchemy.sql import text
-from sqlalchemy import asc, desc, func
+from sqlalchemy.orm import joinedload, make_transient_to_detached, Session
+from sqlalchemy import asc, desc, func, select, update, literal, literal_column, or_, bindparam
+from sqlalchemy.dialects.postgresql import insert
 
-from models import User, UserLog, Match, Team, Prediction, MatchFilter
+from models import User, UserLog, Match, Team, Prediction, Standing, MatchFilter
+from models import MATCH_STATUS_FINISHED, USER_STAGE_SIMPLE
 from db import Db
+from .cache import TTLCache
+from .schedule import ScheduleStore
+from .scoring import points_expression
 
+# match columns which are set only when match is inserted by fixture sync
+MATCH_INSERT_ONLY_FIELDS = ("api_id", "group", "stage", "stadium", "created")
 
+
+def _track_queries(cls):
+    """
+    Queries of every public method are measured under method name, see Db.operation()
+    """
+    def track(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.db_service.operation(method.__name__):
+                return method(self, *args, **kwargs)
+        return wrapper
+
+    for name, attr in list(vars(cls).items()):
+        if isinstance(attr, FunctionType) and not name.startswith("_"):
+            setattr(cls, name, track(attr))
+    return cls
+
+
+# pylint: disable=too-many-public-methods
+@_track_queries
 class StorageService:
-    def __init__(self, db_service: Db, logger: Logger):
+    def __init__(self, db_service: Db, logger: Logger,
+                 user_cache_size: int = 10000, user_cache_ttl: float = 600.0):
         """
         :arg: db - db service
         :arg: logger - logger object
+        :arg: user_cache_size - max number of cached users
+        :arg: user_cache_ttl - seconds user is served from cache before reload
         """
         self.db_service = db_service
         self.logger = logger
+        # api_id -> column values of user at last read or write. Users are built from them
+        # on every call, as ORM instances must not be shared between sessions of threads
+        self.user_cache = TTLCache(user_cache_size, user_cache_ttl)
+        # user id -> frozenset of ids of matches predicted by user
+        self.predicted_cache = TTLCache(user_cache_size, user_cache_ttl)
+        # matches and teams are read from memory, snapshot is replaced on every write
+        self.schedule = ScheduleStore(db_service)
+
+    @property
+    def schedule_version(self) -> int:
+        """
+        Bumped on every match or team write, used to invalidate rendered schedule
+        """
+        return self.schedule.snapshot.version
 
-    def get_user(self, id_: int) -> User:
-        with self.db_service.session_scope() as sess:
-            query = sess.query(User).filter(User.id == id_)
-            user = query.one_or_none()
-
-        return user
+    def unit_of_work(self):
+        """
+        Opens transaction shared by all storage calls of current thread until exit
+        """
+        return self.db_service.unit_of_work()
 
     def get_user_by_api_id(self, api_id: int) -> User:
+        cached = self.user_cache.get(api_id)
+        if cached is not None:
+            return self._detached_user(cached)
+
         with self.db_service.session_scope() as sess:
             query = sess.query(User).filter(User.api_id == api_id)
             user = query.one_or_none()
 
+        if user is not None:
+            self.user_cache.set(api_id, self._user_values(user))
+            # values may be written by transaction which is rolled back
+            self.db_service.on_rollback(lambda: self.user_cache.delete(api_id))
+
         return user
 
-    def create_or_update_user(self, user: User) -> int:
+    def upsert_user(self, api_id: int, username: str, full_name: str) -> User:
+        """
+        Creates user or updates names of existing one in one statement,
+        so concurrent first messages of user can't create duplicates
+        """
+        stmt = insert(User).values(api_id=api_id, username=username, full_name=full_name,
+                                   created=datetime.utcnow())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.api_id],
+            set_={"username": stmt.excluded.username, "full_name": stmt.excluded.full_name}
+        ).returning(*User.__table__.columns)
+
         with self.db_service.session_scope() as sess:
-            sess.add(user)
+            row = sess.execute(stmt).one()
 
+        values = dict(row._mapping)  # pylint: disable=protected-access
+        self.user_cache.set(api_id, values)
+        self.db_service.on_rollback(lambda: self.user_cache.delete(api_id))
+        return self._detached_user(values)
+
+    def create_or_update_user(self, user: User) -> int:
+        values = self._user_values(user)
+        if user.id is not None and self.user_cache.peek(user.api_id) == values:
+            return user.id
+
+        try:
+            with self.db_service.session_scope() as sess:
+                sess.add(user)
+        except Exception:
+            self.user_cache.delete(user.api_id)
+            raise
+
+        self.user_cache.set(user.api_id, values)
+        self.db_service.on_rollback(lambda: self.user_cache.delete(user.api_id))
         return user.id
 
-    def get_user_leaders(self, limit: int = 30) -> list[User, int]:
+    def get_chat_states(self, since: datetime) -> list:
+        """
+        Returns (user_id, api_id, stage, payload, updated) of conversations
+        updated after since
+        """
         with self.db_service.session_scope() as sess:
-            query = sess.query(
-                User,
-                func.sum(Prediction.points).label("points")
-            ).join(Prediction).group_by(User.id).order_by(
-                desc(text("points")), asc(text("user_created"))
+            query = sess.query(User.id, User.api_id, User.chat_stage, User.chat_stage_payload,
+                               User.chat_stage_updated)
+            query = query.filter(User.chat_stage != USER_STAGE_SIMPLE)
+            query = query.filter(User.chat_stage_updated >= since)
+            return query.all()
+
+    def save_chat_states(self, states: list[dict]):
+        """
+        Writes conversation states of users in one batch
+        :arg: states - dicts with user_id, stage, payload and updated keys
+        """
+        table = User.__table__
+        stmt = update(table).where(table.c.id == bindparam("b_user_id")).values(
+            chat_stage=bindparam("b_stage"),
+            chat_stage_payload=bindparam("b_payload"),
+            chat_stage_updated=bindparam("b_updated"),
+        )
+        with self.db_service.session_scope(shared=False) as sess:
+            sess.execute(stmt, [{
+                "b_user_id": state["user_id"],
+                "b_stage": state["stage"],
+                "b_payload": state["payload"],
+                "b_updated": state["updated"],
+            } for state in states])
+
+    def expire_chat_states(self, before: datetime) -> int:
+        """
+        Resets conversations abandoned before given time, returns number of reset
+        """
+        with self.db_service.session_scope(shared=False) as sess:
+            query = sess.query(User).filter(User.chat_stage != USER_STAGE_SIMPLE)
+            query = query.filter(or_(User.chat_stage_updated < before,
+                                     User.chat_stage_updated.is_(None)))
+            return query.update({
+                User.chat_stage: USER_STAGE_SIMPLE,
+                User.chat_stage_payload: None,
+                User.chat_stage_updated: datetime.utcnow(),
+            }, synchronize_session=False)
+
+    def get_user_leaders(self, limit: int = 30) -> list[User, int]:
+        with self.db_service.session_scope(readonly=True) as sess:
+            query = sess.query(User, Standing.points).join(
+                Standing, Standing.user_id == User.id
+            ).order_by(
+                desc(Standing.points), asc(Standing.user_created)
             ).limit(limit)
             rows = query.all()
 
         return rows
 
-    def create_or_update_userlog(self, log: UserLog):
-        with self.db_service.session_scope() as sess:
-            log.created = datetime.utcnow()
-            sess.add(log)
-
-    def get_all_teams(self):
+    def rebuild_standings(self) -> int:
         with self.db_service.session_scope() as sess:
-            teams = sess.query(Team).all()
+            sess.query(Standing).delete(synchronize_session=False)
+            points = select(
+                User.id, func.coalesce(func.sum(Prediction.points), 0), User.created
+            ).join(Prediction, Prediction.user_id == User.id).group_by(User.id)
+            result = sess.execute(insert(Standing).from_select(
+                [Standing.user_id, Standing.points, Standing.user_created], points
+            ))
 
-        return teams
+        return result.rowcount
 
-    def get_team(self, id_: int) -> Team:
+    def score_match(self, match: Match) -> list[Prediction]:
+        """
+        Scores all predictions of finished match, adds points to standings and marks match
+        as processed in one transaction, so points can't be added twice.
+        Returns predictions of users with enabled notifications.
+        """
         with self.db_service.session_scope() as sess:
-            query = sess.query(Team).filter(Team.id == id_)
-            match = query.one_or_none()
+            sess.query(Prediction).filter(Prediction.match_id == match.id).update({
+                Prediction.points: points_expression(match.home_goals_90, match.away_goals_90),
+                Prediction.updated: datetime.utcnow(),
+            }, synchronize_session=False)
+
+            points = select(
+                Prediction.user_id, Prediction.points, User.created
+            ).join(User, User.id == Prediction.user_id).where(
+                Prediction.match_id == match.id, Prediction.points > 0
+            )
+            stmt = insert(Standing).from_select(
+                [Standing.user_id, Standing.points, Standing.user_created], points
+            )
+            sess.execute(stmt.on_conflict_do_update(
+                index_elements=[Standing.user_id],
+                set_={"points": Standing.points + stmt.excluded.points}
+            ))
 
-        return match
+            match.processed = True
+            match.updated = datetime.utcnow()
+            sess.add(match)
 
-    def get_team_by_api_id(self, api_id: int) -> Team:
-        with self.db_service.session_scope() as sess:
-            query = sess.query(Team).filter(Team.api_id == api_id)
-            team = query.one_or_none()
+            query = sess.query(Prediction).join(Prediction.user)
+            query = query.options(joinedload(Prediction.user))
+            query = query.filter(Prediction.match_id == match.id)
+            query = query.filter(User.notifications_on.is_(True))
+            predictions = query.all()
 
-        return team
+        self.schedule.refresh()
+        return predictions
 
-    def create_or_update_team(self, team: Team) -> int:
+    def create_userlogs(self, logs: list[UserLog]):
         with self.db_service.session_scope() as sess:
-            sess.add(team)
+            sess.bulk_insert_mappings(UserLog, [{
+                "user_id": log.user_id,
+                "username": log.username,
+                "request": log.request,
+                "response": log.response,
+                "created": log.created or datetime.utcnow(),
+            } for log in logs])
 
-        return team.id
+    def get_all_teams(self) -> list[Team]:
+        return list(self.schedule.snapshot.teams)
 
     def find_matches(self, filter_: MatchFilter) -> list[Match]:
-        with self.db_service.session_scope() as sess:
-            query = sess.query(Match)
-            if filter_.group:
-                query = query.filter(Match.group == filter_.group)
-            if filter_.stage:
-                query = query.filter(Match.stage == filter_.stage)
-            if filter_.team_id:
-                query = query.filter(
-                    Match.team_home_id == filter_.team_id or
-                    Match.team_away_id == filter_.team_id
-                )
-            if filter_.datetime:
-                date = filter_.datetime.date()
-                from_date = datetime(date.year, date.month, date.day)
-                to_date = from_date + timedelta(1)
-                query = query.filter(from_date <= Match.datetime)
-                query = query.filter(to_date >= Match.datetime)
-
-            query = query.order_by(asc(Match.datetime))
-
-            matches = query.options(
-                joinedload(Match.team_home), joinedload(Match.team_away)
-            ).all()
-
-        return matches
+        return self.schedule.snapshot.find_matches(filter_)
 
-    def get_match(self, id_: int) -> Match:
-        with self.db_service.session_scope() as sess:
-            query = sess.query(Match).filter(Match.id == id_)
-            match = query.options(
-                joinedload(Match.team_home), joinedload(Match.team_away)
-            ).one_or_none()
-
-        return match
+    def get_all_matches(self) -> list[Match]:
+        return list(self.schedule.snapshot.matches)
 
-    def get_match_by_api_id(self, api_id: int) -> Match:
+    def get_unprocessed_finished_matches(self) -> list[Match]:
         with self.db_service.session_scope() as sess:
-            query = sess.query(Match).filter(Match.api_id == api_id)
-            match = query.one_or_none()
+            query = sess.query(Match).filter(Match.status == MATCH_STATUS_FINISHED)
+            query = query.filter(or_(Match.processed.is_(None), Match.processed.is_(False)))
+            matches = query.order_by(asc(Match.datetime)).all()
 
-        return match
+        return matches
 
-    def create_or_update_match(self, match: Match) -> int:
+    def save_fixtures(self, new_teams: list[Team], matches: list[dict]):
+        """
+        Saves fixture changes in one transaction, teams and matches are upserted by api_id.
+        Match rows refer teams by team_home_api_id and team_away_api_id keys,
+        processed matches are not updated.
+        """
+        now = datetime.utcnow()
         with self.db_service.session_scope() as sess:
-            if match.id == 0:
-                match.created = datetime.utcnow()
-            match.updated = datetime.utcnow()
-            sess.add(match)
+            if new_teams:
+                sess.execute(insert(Team).values([{
+                    "api_id": team.api_id, "title": team.title, "group": team.group
+                } for team in new_teams]).on_conflict_do_nothing(index_elements=[Team.api_id]))
+            team_ids = dict(sess.query(Team.api_id, Team.id).all())
+
+            for row in matches:
+                row["team_home_id"] = team_ids[row.pop("team_home_api_id")]
+                row["team_away_id"] = team_ids[row.pop("team_away_api_id")]
+                row["created"] = now
+                row["updated"] = now
+
+            if matches:
+                stmt = insert(Match).values(matches)
+                sess.execute(stmt.on_conflict_do_update(
+                    index_elements=[Match.api_id],
+                    set_={key: stmt.excluded[key] for key in matches[0]
+                          if key not in MATCH_INSERT_ONLY_FIELDS},
+                    where=Match.processed.isnot(True)
+                ))
+
+        self.schedule.refresh()
 
-        return match.id
+    def get_match(self, id_: int) -> Match:
+        return self.schedule.snapshot.get_match(id_)
 
     def get_next_match_prediction(self, user_id: int):
-        with self.db_service.session_scope() as sess:
-            subquery = sess.query(Prediction).filter(Prediction.user_id == user_id)
-            subquery = subquery.with_entities(Prediction.match_id)
+        predicted = self._get_predicted_match_ids(user_id)
+        for match in self.schedule.snapshot.upcoming(datetime.utcnow()):
+            if match.id not in predicted:
+                return match
+        return None
 
-            query = sess.query(Match).order_by(asc(Match.datetime))
-            query = query.filter(Match.id.not_in(subquery))
-            query = query.filter(Match.datetime > datetime.utcnow())
-            return query.first()
+    def _get_predicted_match_ids(self, user_id: int) -> frozenset:
+        predicted = self.predicted_cache.get(user_id)
+        if predicted is not None:
+            return predicted
 
-    def find_prediction(self, user_id: int, match_id: int) -> Prediction:
         with self.db_service.session_scope() as sess:
-            query = sess.query(Prediction)
-            query = query.options(
-                joinedload(Prediction.match)
-            )
-            query = query.filter(Prediction.match_id == match_id)
-            query = query.filter(Prediction.user_id == user_id)
-            prediction = query.one_or_none()
-
-        return prediction
-
-    def get_user_predictions(self, user_id: int) -> list[Prediction]:
+            query = sess.query(Prediction.match_id).filter(Prediction.user_id == user_id)
+            predicted = frozenset(row.match_id for row in query)
+
+        self.predicted_cache.set(user_id, predicted)
+        self.db_service.on_rollback(lambda: self.predicted_cache.delete(user_id))
+        return predicted
+
+    def _add_predicted_match(self, user_id: int, match_id: int):
+        # sets are replaced, not modified, as they may be read by other threads
+        predicted = self.predicted_cache.peek(user_id)
+        if predicted is not None:
+            self.predicted_cache.set(user_id, predicted | {match_id})
+            self.db_service.on_rollback(lambda: self.predicted_cache.delete(user_id))
+
+    def get_user_predictions_page(self, user_id: int, after: int = 0, before: int = None,
+                                  limit: int = 10) -> tuple[list[Prediction], bool]:
+        """
+        Keyset page of user predictions ordered by match id: next after match id `after`
+        or, if `before` is set, previous before match id `before`.
+        Returns predictions without matches loaded and whether there are more
+        predictions in that direction.
+        Read from primary, as page is cached and must show prediction user just made.
+        """
         with self.db_service.session_scope() as sess:
-            query = sess.query(Prediction)
-            query = query.filter(Prediction.user_id == user_id)
-            predictions = query.options(
-                joinedload(Prediction.match).joinedload(Match.team_home),
-                joinedload(Prediction.match).joinedload(Match.team_away),
-            ).order_by(asc(text("prediction_match_id"))).all()
-
-        return predictions
-
-    def get_match_predictions(self, match_id: int) -> list[Prediction]:
+            query = sess.query(Prediction).filter(Prediction.user_id == user_id)
+            if before is not None:
+                query = query.filter(Prediction.match_id < before)
+                query = query.order_by(desc(Prediction.match_id))
+            else:
+                query = query.filter(Prediction.match_id > after)
+                query = query.order_by(asc(Prediction.match_id))
+            predictions = query.limit(limit + 1).all()
+
+        has_more = len(predictions) > limit
+        predictions = predictions[:limit]
+        if before is not None:
+            predictions.reverse()
+        return predictions, has_more
+
+    def get_user_points(self, user_id: int) -> int:
+        # read from primary, as predictions page shows it together with scored predictions
         with self.db_service.session_scope() as sess:
-            query = sess.query(Prediction)
-            query = query.options(
-                joinedload(Prediction.match).joinedload(Match.team_home),
-                joinedload(Prediction.match).joinedload(Match.team_away),
-                joinedload(Prediction.user)
-            )
-            query = query.filter(Prediction.match_id == match_id)
-            predictions = query.all()
+            points = sess.query(Standing.points).filter(Standing.user_id == user_id).scalar()
 
-        return predictions
+        return points or 0
 
-    def create_or_update_prediction(self, prediction: Prediction) -> int:
-        with self.db_service.session_scope() as sess:
-            if prediction.id == 0:
-                prediction.created = datetime.utcnow()
-            prediction.updated = datetime.utcnow()
-            sess.add(prediction)
+    def upsert_prediction(self, user_id: int, match_id: int,
+                          home_goals: int, away_goals: int) -> int:
+        """
+        Creates prediction or updates score of existing one in one statement
+        """
+        now = datetime.utcnow()
+        stmt = insert(Prediction).values(user_id=user_id, match_id=match_id,
+                                         home_goals=home_goals, away_goals=away_goals,
+                                         points=0, created=now, updated=now)
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_prediction_user_match",
+            set_={
+                "home_goals": stmt.excluded.home_goals,
+                "away_goals": stmt.excluded.away_goals,
+                "updated": stmt.excluded.updated,
+            }
+            # xmax of row is 0 only if it was inserted, not updated
+        ).returning(Prediction.id, literal_column("xmax = 0").label("inserted"))
 
-        return prediction.id
+        with self.db_service.session_scope() as sess:
+            row = sess.execute(stmt).one()
+            if row.inserted:
+                self._ensure_standing(sess, user_id)
+
+        self._add_predicted_match(user_id, match_id)
+        return row.id
+
+    @staticmethod
+    def _ensure_standing(sess: Session, user_id: int):
+        # Users appear in leaderboard with their first prediction, as it was with SUM query
+        user = select(User.id, literal(0), User.created).where(User.id == user_id)
+        sess.execute(insert(Standing).from_select(
+            [Standing.user_id, Standing.points, Standing.user_created], user
+        ).on_conflict_do_nothing(index_elements=[Standing.user_id]))
+
+    @staticmethod
+    def _user_values(user: User) -> dict:
+        return {prop.key: getattr(user, prop.key) for prop in User.__mapper__.column_attrs}
+
+    @staticmethod
+    def _detached_user(values: dict) -> User:
+        # detached user is updated, not inserted, when it is saved
+        user = User(**values)
+        make_transient_to_detached(user)
+        return user
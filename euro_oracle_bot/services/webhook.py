@@ -0,0 +1,153 @@
+"""
+Webhook update ingestion
+"""
+import asyncio
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+from telebot import apihelper
+from telebot.types import Update
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY_SIZE = 1024 * 1024
+
+HTTP_STATUSES = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+}
+
+
+def set_webhook(token: str, url: str, secret: str):
+    # TeleBot.set_webhook does not support secret_token yet
+    payload = {"url": url, "secret_token": secret}
+    # pylint: disable=protected-access
+    apihelper._make_request(token, "setWebhook", params=payload, method="post")
+
+
+# pylint: disable=too-many-instance-attributes,too-many-arguments
+class WebhookServer:
+    def __init__(self,
+                 process_update: Callable[[Update], None],
+                 url: str,
+                 host: str,
+                 port: int,
+                 secret: str,
+                 concurrency: int,
+                 logger: Logger):
+        """
+        :arg: process_update - callable which passes update to bot handlers
+        :arg: url - public webhook url, its path is served by this server
+        :arg: host - listen address
+        :arg: port - listen port
+        :arg: secret - expected X-Telegram-Bot-Api-Secret-Token value, must not be empty
+        :arg: concurrency - max number of updates accepted simultaneously
+        :arg: logger - logger object
+        """
+        self.process_update = process_update
+        self.path = urlsplit(url).path or "/"
+        self.host = host
+        self.port = port
+        if not secret:
+            raise ValueError("webhook secret is required")
+        self.secret = secret.encode()
+        self.concurrency = max(concurrency, 1)
+        self.logger = logger
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                            thread_name_prefix="webhook")
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self._executor.shutdown(wait=True)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = await self._read_headers(reader)
+
+                length = int(headers.get("content-length", "0"))
+                if length > MAX_BODY_SIZE:
+                    await self._write_response(writer, 413, False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                status = await self._handle_request(method, target, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as exc:
+            self.logger.debug(f"webhook connection dropped: {str(exc)}")
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method: str, target: str, headers: dict, body: bytes) -> int:
+        if urlsplit(target).path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        token = headers.get(SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.logger.warning("webhook request with invalid secret token")
+            return 403
+
+        try:
+            update = Update.de_json(body.decode("utf-8"))
+        except (ValueError, KeyError, TypeError) as exc:
+            self.logger.error(f"failed to parse webhook update: {str(exc)}")
+            return 400
+
+        # Telegram waits for the response before sending next updates, so reply as soon
+        # as there is a free slot and let the executor process update in background
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(self._executor,
+                                                            self._process, update)
+        future.add_done_callback(lambda _: self._slots.release())
+        return 200
+
+    def _process(self, update: Update):
+        try:
+            self.process_update(update)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error(f"failed to process update {update.update_id}: {str(exc)}")
+
+    @staticmethod
+    async def _read_headers(reader: asyncio.StreamReader) -> dict:
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    async def _write_response(writer: asyncio.StreamWriter, status: int, keep_alive: bool):
+        connection = "keep-alive" if keep_alive else "close"
+        writer.write(f"HTTP/1.1 {status} {HTTP_STATUSES[status]}\r\n"
+                     f"Content-Length: 0\r\nConnection: {connection}\r\n\r\n".encode())
+        await writer.drain()
@@ -0,0 +1,116 @@
+"""
+Multi-process mode: front process receives updates and passes them to worker processes
+"""
+import multiprocessing
+import threading
+from logging import Logger
+from typing import Callable, Optional
+
+from telebot.types import Update
+
+from metrics import Counter
+from .dispatcher import UpdateDispatcher
+
+
+# pylint: disable=too-few-public-methods
+class _WorkerProcess:
+    def __init__(self, idx: int, context, max_queue: int):
+        self.idx = idx
+        self.queue = context.Queue(max_queue)
+        self.ready = context.Event()
+        self.leader = context.Value("b", 0)
+        self.restarts = Counter()
+        self.process: Optional[multiprocessing.Process] = None
+
+
+# pylint: disable=too-many-instance-attributes
+class WorkerPool:
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 target: Callable,
+                 args: tuple,
+                 processes: int,
+                 logger: Logger,
+                 max_queue: int = 0,
+                 check_interval: float = 5.0):
+        """
+        :arg: target - worker process entry point, it is called with args followed by
+        worker index, number of workers, update queue, ready event and leader flag
+        :arg: args - leading arguments of target, they must be picklable
+        :arg: processes - number of worker processes
+        :arg: logger - logger object
+        :arg: max_queue - max queued updates per worker, 0 means unbounded
+        :arg: check_interval - seconds between checks that workers are alive
+        """
+        self.target = target
+        self.args = args
+        self.logger = logger
+        self.check_interval = check_interval
+        # workers are started clean, without threads and connections of front process
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_WorkerProcess(idx, self._context, max_queue)
+                         for idx in range(max(processes, 1))]
+        self._stopped = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stopped.clear()
+        for worker in self._workers:
+            self._spawn(worker)
+        self._monitor = threading.Thread(target=self._run_monitor, name="worker-monitor",
+                                         daemon=True)
+        self._monitor.start()
+
+    def stop(self, timeout: float = 30.0):
+        self._stopped.set()
+        for worker in self._workers:
+            worker.queue.put(None)
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                self.logger.error(f"worker {worker.idx} did not stop in time, terminate it")
+                worker.process.terminate()
+                worker.process.join()
+
+    def dispatch(self, update: Update):
+        # updates of one chat always go to the same process, so they are handled in order
+        # and conversation state of chat stays in memory of one process
+        worker = self._workers[UpdateDispatcher.shard_key(update) % len(self._workers)]
+        worker.queue.put(update)
+
+    def ready(self) -> tuple[bool, dict]:
+        workers = [{
+            "worker": worker.idx,
+            "pid": worker.process.pid if worker.process is not None else None,
+            "alive": worker.process is not None and worker.process.is_alive(),
+            "ready": worker.ready.is_set(),
+            "leader": bool(worker.leader.value),
+            "restarts": worker.restarts.value,
+        } for worker in self._workers]
+        ready = all(worker["alive"] and worker["ready"] for worker in workers)
+        return ready, {"ready": ready, "workers": workers}
+
+    def _spawn(self, worker: _WorkerProcess):
+        worker.ready.clear()
+        worker.leader.value = 0
+        worker.process = self._context.Process(
+            target=self.target,
+            args=(*self.args, worker.idx, len(self._workers), worker.queue, worker.ready,
+                  worker.leader),
+            name=f"worker-{worker.idx}",
+        )
+        worker.process.start()
+        self.logger.info(f"Worker {worker.idx} started, pid {worker.process.pid}")
+
+    def _run_monitor(self):
+        while not self._stopped.wait(self.check_interval):
+            for worker in self._workers:
+                if worker.process.is_alive() or self._stopped.is_set():
+                    continue
+                # queued updates are kept, restarted worker handles them
+                self.logger.error(f"worker {worker.idx} exited with code "
+                                  f"{worker.process.exitcode}, restart it")
+                worker.restarts.inc()
+                self._spawn(worker)
@@ -10,12 +10,82 @@ class Settings(BaseSettings):
     :attr: bot_token
     :attr: postgres_dsn
     :attr: "logger_level" logging level
+    :attr: "postgres_replica_dsns" comma separated DSNs of read replicas
+    :attr: "db_pool_size" number of DB connections kept open
+    :attr: "db_max_overflow" max DB connections opened above pool size under load
+    :attr: "db_pool_timeout" seconds to wait for free DB connection before error
+    :attr: "db_pool_recycle" seconds after which DB connection is reopened, -1 disables it
+    :attr: "db_pool_pre_ping" check DB connection is alive before use
+    :attr: "db_statement_timeout" Postgres statement timeout in milliseconds, 0 disables it
+    :attr: "telegram_api_url" Telegram Bot API base url (e.g. local fake server)
+    :attr: "webhook_enabled" receive updates via webhook instead of long polling
+    :attr: "webhook_url" public url registered with setWebhook
+    :attr: "webhook_host" webhook server listen address
+    :attr: "webhook_port" webhook server listen port
+    :attr: "webhook_secret" secret token checked on every webhook request
+    :attr: "webhook_concurrency" max number of webhook requests accepted simultaneously
+    :attr: "handler_workers" number of handler workers, updates are sharded by chat id
+    :attr: "handler_queue_size" max queued updates per handler worker, 0 means unbounded
+    :attr: "worker_processes" number of handler processes, updates are sharded by chat id,
+    1 runs everything in one process
+    :attr: "leader_lock_id" Postgres advisory lock key taken by process running sync and scoring
+    :attr: "schedule_refresh_interval" seconds between checks that schedule was changed
+    by another process
+    :attr: "status_host" health and readiness server listen address
+    :attr: "status_port" health and readiness server listen port, 0 disables it
+    :attr: "userlog_batch_size" user logs are written when that many are buffered
+    :attr: "userlog_flush_interval" max seconds user log stays in buffer
+    :attr: "user_cache_size" max number of users cached in memory
+    :attr: "user_cache_ttl" seconds user is served from cache before reload
+    :attr: "conversation_ttl" seconds after which abandoned conversation (e.g. score entry) is reset
+    :attr: "conversation_flush_interval" max seconds conversation state change stays unwritten
+    :attr: "notification_workers" number of threads sending match result notifications
+    :attr: "notification_max_retries" max retries of failed notification
+    :attr: "data_api_url" elenasport.io data API base url
+    :attr: "data_api_auth_url" elenasport.io OAuth2 server base url
+    :attr: "data_api_timeout" elenasport.io request timeout in seconds
+    :attr: "fixtures_snapshot_path" file with last good fixtures, empty value disables it
+    :attr: "fixtures_max_age" seconds after last good fixtures fetch when fixtures are stale
     """
 
     bot_token: str
     data_api_token: str
     postgres_dsn: PostgresDsn
     logger_level: str = "DEBUG"
+    postgres_replica_dsns: str = ""
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = False
+    db_statement_timeout: int = 0
+    telegram_api_url: str = ""
+    webhook_enabled: bool = False
+    webhook_url: str = ""
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8443
+    webhook_secret: str = ""
+    webhook_concurrency: int = 8
+    handler_workers: int = 4
+    handler_queue_size: int = 1000
+    worker_processes: int = 1
+    leader_lock_id: int = 20200611
+    schedule_refresh_interval: float = 30.0
+    status_host: str = "0.0.0.0"
+    status_port: int = 0
+    userlog_batch_size: int = 100
+    userlog_flush_interval: float = 5.0
+    user_cache_size: int = 10000
+    user_cache_ttl: float = 600.0
+    conversation_ttl: float = 3600.0
+    conversation_flush_interval: float = 1.0
+    notification_workers: int = 8
+    notification_max_retries: int = 3
+    data_api_url: str = "https://football.elenasport.io"
+    data_api_auth_url: str = "https://oauth2.elenasport.io"
+    data_api_timeout: float = 10.0
+    fixtures_snapshot_path: str = "fixtures.json.gz"
+    fixtures_max_age: float = 21600.0
 
     class Config:
         """